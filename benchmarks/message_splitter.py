@@ -0,0 +1,93 @@
+"""
+Benchmarks splitting long generated answers into Telegram messages: the fixed-size split that was used before
+against the markdown-aware MessageSplitter, for complete answers and for answers streamed in small deltas.
+
+Run from the repository root: python benchmarks/message_splitter.py
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bot'))
+
+from message_splitter import MessageSplitter  # noqa: E402
+from stream_buffer import StreamBuffer  # noqa: E402
+
+WORDS = 'the quick brown *fox* jumps over `lazy` dogs while _markdown_ entities keep coming'.split()
+FENCE_LINE_PATTERN = re.compile(r'^ {0,3}```', re.MULTILINE)
+
+
+def generate_answer(length: int) -> str:
+    """
+    Generates an answer of about the given length, made of paragraphs and python code blocks.
+    """
+    blocks = []
+    while sum(map(len, blocks)) < length:
+        if random.random() < 0.3:
+            lines = [' '.join(random.choices(WORDS, k=random.randint(3, 12))) for _ in range(random.randint(5, 120))]
+            blocks.append('```python\n' + '\n'.join(lines) + '\n```')
+        else:
+            blocks.append(' '.join(random.choices(WORDS, k=random.randint(20, 200))))
+    return '\n\n'.join(blocks)
+
+
+def fixed_split(text: str, size: int = 4096) -> list[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def markdown_split(text: str, size: int = 4096) -> list[str]:
+    splitter = MessageSplitter(size)
+    chunks = splitter.split(text)
+    last = splitter.current(text)
+    return chunks + ([last] if last.strip() else [])
+
+
+def unbalanced_chunks(chunks: list[str]) -> int:
+    """
+    Counts the chunks with an odd number of fence lines, i.e. a code block cut in half.
+    """
+    return sum(1 for chunk in chunks if len(FENCE_LINE_PATTERN.findall(chunk)) % 2)
+
+
+def main():
+    random.seed(1)
+    for length in (64_000, 256_000, 1_000_000):
+        text = generate_answer(length)
+        for name, split in (('fixed', fixed_split), ('markdown', markdown_split)):
+            started = time.perf_counter()
+            for _ in range(5):
+                chunks = split(text)
+            elapsed = (time.perf_counter() - started) / 5
+            assert all(len(chunk) <= 4096 for chunk in chunks), name
+            print(f'{len(text):>8} chars {name:>8}: {elapsed * 1000:7.2f} ms, {len(chunks):4} chunks, '
+                  f'{unbalanced_chunks(chunks):3} with unbalanced fences')
+
+        # Apart from the fences and whitespace, the chunks hold the whole answer
+        strip = lambda value: re.sub(r'```\w*|\s', '', value)
+        assert strip('\n'.join(markdown_split(text))) == strip(text)
+
+        # Streamed in 4-character deltas: splitting the whole answer again on every delta,
+        # against feeding the growing buffer to a single splitter
+        deltas = [text[i:i + 4] for i in range(0, len(text), 4)]
+        if length <= 256_000:
+            started = time.perf_counter()
+            answer = ''
+            for delta in deltas:
+                answer += delta
+                fixed_split(answer)
+            print(f'{"":>14} streamed, split again per delta: {(time.perf_counter() - started) * 1000:9.1f} ms')
+        started = time.perf_counter()
+        buffer, splitter, chunks = StreamBuffer(), MessageSplitter(), []
+        for delta in deltas:
+            buffer.append(delta)
+            chunks += splitter.split(buffer)
+            splitter.current(buffer)
+        last = splitter.current(buffer)
+        print(f'{"":>14} streamed, incremental splitter:  {(time.perf_counter() - started) * 1000:9.1f} ms')
+        assert chunks + ([last] if last.strip() else []) == markdown_split(text), 'the streamed split differs'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Benchmarks the per-turn cost of knowing the size of a conversation: counting the tokens of the whole history
+again on every turn, as before the token ledger, against counting only the new message and reading the ledger.
+Uses tiktoken, which downloads its encoding the first time it runs.
+
+Run from the repository root: python benchmarks/token_ledger.py
+"""
+import asyncio
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bot'))
+
+import tiktoken  # noqa: E402
+
+from openai_helper import OpenAIHelper  # noqa: E402
+from plugin_manager import PluginManager  # noqa: E402
+
+MODEL = 'gpt-4'
+CONFIG = {
+    'api_key': 'unused', 'model': MODEL, 'assistant_prompt': 'You are a helpful assistant.',
+    'response_cache': 'off', 'history_strategy': 'summarise', 'max_history_size': 1000,
+}
+TURNS = 50
+
+
+def count_history_tokens(encoding: tiktoken.Encoding, messages: list) -> int:
+    """
+    Counts the tokens of the whole history like the helper did before the ledger (text messages only).
+    """
+    num_tokens = 0
+    for message in messages:
+        num_tokens += 3
+        for key, value in message.items():
+            num_tokens += len(encoding.encode(value))
+            if key == 'name':
+                num_tokens += 1
+    return num_tokens + 3
+
+
+async def main():
+    random.seed(0)
+    words = [''.join(random.choices(string.ascii_lowercase, k=random.randint(2, 9))) for _ in range(2000)]
+    message = lambda: ' '.join(random.choices(words, k=120))
+    encoding = tiktoken.encoding_for_model(MODEL)
+
+    for history_size in (10, 100, 500):
+        helper = OpenAIHelper(CONFIG, PluginManager({}))
+        await helper.reset_chat_history(1)
+        for i in range(history_size):
+            await helper._OpenAIHelper__add_to_history(1, 'user' if i % 2 == 0 else 'assistant', message())
+        messages = helper.conversations[1]
+        assert count_history_tokens(encoding, messages) == helper._OpenAIHelper__conversation_tokens(1)
+
+        started = time.perf_counter()
+        for _ in range(TURNS):
+            count_history_tokens(encoding, messages + [{'role': 'user', 'content': message()}])
+        recount = (time.perf_counter() - started) / TURNS
+
+        started = time.perf_counter()
+        for _ in range(TURNS):
+            await helper._OpenAIHelper__add_to_history(1, 'user', message())
+            helper._OpenAIHelper__conversation_tokens(1)
+        ledger = (time.perf_counter() - started) / TURNS
+
+        print(f'{history_size:>4} messages: recount {recount * 1000:7.3f} ms/turn, ledger {ledger * 1000:7.3f} ms/turn')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+from collections import Counter
+
+from telegram import Bot, constants
+
+# Chat actions in order of priority, the first action of the running jobs is shown
+CHAT_ACTION_PRIORITIES = [
+    constants.ChatAction.UPLOAD_PHOTO,
+    constants.ChatAction.UPLOAD_VIDEO,
+    constants.ChatAction.UPLOAD_VOICE,
+    constants.ChatAction.UPLOAD_DOCUMENT,
+    constants.ChatAction.RECORD_VOICE,
+    constants.ChatAction.RECORD_VIDEO,
+    constants.ChatAction.TYPING,
+]
+
+
+def chat_action_priority(action: str) -> int:
+    """
+    Returns the priority of a chat action, lower values are shown first
+    """
+    try:
+        return CHAT_ACTION_PRIORITIES.index(action)
+    except ValueError:
+        return len(CHAT_ACTION_PRIORITIES)
+
+
+class ChatActionIndicator:
+    """
+    Shows a chat action while jobs are running in a chat. The running jobs of each chat are reference counted,
+    so that a single action is sent per chat and interval, however many jobs there are, showing the action
+    with the highest priority. Sending stops as soon as the last job of the chat ends.
+    """
+    interval = 4.5  # Telegram shows a chat action for 5 seconds
+
+    def __init__(self):
+        self.chats = {}  # {(chat_id, thread_id): {'actions': Counter, 'changed': Event, 'task': Task}}
+
+    @contextlib.asynccontextmanager
+    async def indicate(self, bot: Bot, chat_id: int, thread_id: int | None, action: str):
+        """
+        Shows the given chat action in the chat while the context is active.
+        :param bot: The bot to send the chat actions with
+        :param chat_id: The chat to show the action in
+        :param thread_id: The message thread to show the action in, if any
+        :param action: The chat action to show
+        """
+        key = (chat_id, thread_id)
+        chat = self.chats.get(key)
+        if chat is None:
+            chat = self.chats[key] = {'actions': Counter(), 'changed': asyncio.Event(), 'task': None}
+        actions = chat['actions']
+        if not actions or chat_action_priority(action) < min(map(chat_action_priority, actions)):
+            # Show an action that outranks the current one right away
+            chat['changed'].set()
+        actions[action] += 1
+        if chat['task'] is None:
+            chat['task'] = asyncio.create_task(self.__send_actions(bot, key, chat))
+
+        try:
+            yield
+        finally:
+            actions[action] -= 1
+            if actions[action] <= 0:
+                del actions[action]
+            if not actions:
+                chat['task'].cancel()
+                del self.chats[key]
+
+    def __len__(self) -> int:
+        return len(self.chats)
+
+    async def __send_actions(self, bot: Bot, key: tuple, chat: dict):
+        """
+        Sends the chat action with the highest priority every interval, or as soon as it changes.
+        """
+        chat_id, thread_id = key
+        while True:
+            chat['changed'].clear()
+            action = min(chat['actions'], key=chat_action_priority)
+            try:
+                await bot.send_chat_action(chat_id=chat_id, action=action, message_thread_id=thread_id)
+            except Exception as e:
+                logging.debug(f'Failed to send chat action: {str(e)}')
+            try:
+                await asyncio.wait_for(chat['changed'].wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import functools
+import json
+import logging
+import sqlite3
+import weakref
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import redis.asyncio as redis
+
+
+class ConversationStore(ABC):
+    """
+    A storage interface for conversation histories.
+    Messages are written through as soon as they are added to a conversation, and conversations
+    are loaded lazily the first time a chat is accessed, so that they survive restarts and can be
+    shared between several instances of the bot.
+    A conversation is a dictionary with the following keys:
+    - messages: the list of messages sent to the model
+    - tokens: the cumulative token count of each message
+    - is_vision: whether the conversation uses the vision model
+    - last_updated: the timestamp of the last request
+    """
+
+    @abstractmethod
+    async def load(self, chat_id: int) -> dict | None:
+        """
+        Load the conversation of the given chat, or None if there is none.
+        """
+        pass
+
+    @abstractmethod
+    async def save(self, chat_id: int, conversation: dict):
+        """
+        Replace the whole conversation of the given chat (e.g. after a reset or a summary).
+        """
+        pass
+
+    @abstractmethod
+    async def append(self, chat_id: int, message: dict, tokens: int):
+        """
+        Append a message and its cumulative token count to the conversation of the given chat.
+        """
+        pass
+
+    @abstractmethod
+    async def touch(self, chat_id: int, is_vision: bool, last_updated: datetime.datetime):
+        """
+        Update the vision flag and the last update timestamp of the conversation of the given chat.
+        """
+        pass
+
+    @abstractmethod
+    async def delete(self, chat_id: int):
+        """
+        Delete the conversation of the given chat.
+        """
+        pass
+
+    async def is_stale(self, chat_id: int) -> bool:
+        """
+        Whether another instance of the bot changed the conversation of the given chat since this instance
+        last loaded or wrote it, so that it has to be loaded again. Stores that aren't shared never are.
+        """
+        return False
+
+
+class MemoryConversationStore(ConversationStore):
+    """
+    Keeps conversations in the process memory only, so they are lost on restart.
+    The conversations are already held by the OpenAIHelper, so nothing has to be stored here.
+    """
+
+    async def load(self, chat_id: int) -> dict | None:
+        return None
+
+    async def save(self, chat_id: int, conversation: dict):
+        pass
+
+    async def append(self, chat_id: int, message: dict, tokens: int):
+        pass
+
+    async def touch(self, chat_id: int, is_vision: bool, last_updated: datetime.datetime):
+        pass
+
+    async def delete(self, chat_id: int):
+        pass
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    Stores conversations in a local SQLite database.
+    The database is accessed from a single worker thread, so that queries and commits don't block the event loop.
+    """
+
+    def __init__(self, path: str):
+        """
+        Opens (and creates if needed) the database at the given path.
+        :param path: The path of the SQLite database file
+        """
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS conversations ('
+                                'chat_id INTEGER PRIMARY KEY, is_vision INTEGER NOT NULL, last_updated TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS messages ('
+                                'id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, '
+                                'message TEXT NOT NULL, tokens INTEGER NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS messages_chat_id ON messages (chat_id, id)')
+        self.connection.commit()
+
+    async def load(self, chat_id: int) -> dict | None:
+        return await self.__run(self.__load, chat_id)
+
+    async def save(self, chat_id: int, conversation: dict):
+        await self.__run(self.__save, chat_id, conversation)
+
+    async def append(self, chat_id: int, message: dict, tokens: int):
+        await self.__run(self.__append, chat_id, message, tokens)
+
+    async def touch(self, chat_id: int, is_vision: bool, last_updated: datetime.datetime):
+        await self.__run(self.__touch, chat_id, is_vision, last_updated)
+
+    async def delete(self, chat_id: int):
+        await self.__run(self.__delete, chat_id)
+
+    async def __run(self, function, *args):
+        """
+        Runs the given function in the worker thread of the database. Writes that were started
+        are completed even if the caller is cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args))
+
+    def __load(self, chat_id: int) -> dict | None:
+        rows = self.connection.execute('SELECT message, tokens FROM messages WHERE chat_id = ? ORDER BY id',
+                                       (chat_id,)).fetchall()
+        if len(rows) == 0:
+            return None
+        state = self.connection.execute('SELECT is_vision, last_updated FROM conversations WHERE chat_id = ?',
+                                        (chat_id,)).fetchone() or (0, None)
+        return {
+            'messages': [json.loads(message) for message, _ in rows],
+            'tokens': [tokens for _, tokens in rows],
+            'is_vision': bool(state[0]),
+            'last_updated': datetime.datetime.fromisoformat(state[1]) if state[1] else None,
+        }
+
+    def __save(self, chat_id: int, conversation: dict):
+        with self.connection:
+            self.__upsert_conversation(chat_id, conversation['is_vision'], conversation['last_updated'])
+            self.connection.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+            self.connection.executemany('INSERT INTO messages (chat_id, message, tokens) VALUES (?, ?, ?)',
+                                        [(chat_id, json.dumps(message), tokens) for message, tokens
+                                         in zip(conversation['messages'], conversation['tokens'])])
+
+    def __append(self, chat_id: int, message: dict, tokens: int):
+        with self.connection:
+            self.connection.execute('INSERT INTO messages (chat_id, message, tokens) VALUES (?, ?, ?)',
+                                    (chat_id, json.dumps(message), tokens))
+
+    def __touch(self, chat_id: int, is_vision: bool, last_updated: datetime.datetime):
+        with self.connection:
+            self.__upsert_conversation(chat_id, is_vision, last_updated)
+
+    def __delete(self, chat_id: int):
+        with self.connection:
+            self.connection.execute('DELETE FROM conversations WHERE chat_id = ?', (chat_id,))
+            self.connection.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+
+    def __upsert_conversation(self, chat_id: int, is_vision: bool, last_updated: datetime.datetime | None):
+        self.connection.execute('INSERT INTO conversations (chat_id, is_vision, last_updated) VALUES (?, ?, ?) '
+                                'ON CONFLICT (chat_id) DO UPDATE SET '
+                                'is_vision = excluded.is_vision, last_updated = excluded.last_updated',
+                                (chat_id, int(is_vision), last_updated.isoformat() if last_updated else None))
+
+
+class RedisConversationStore(ConversationStore):
+    """
+    Stores conversations in Redis, so that several instances of the bot can share them.
+    Every write of the messages increments a version number, which is checked on every access so that
+    an instance loads a conversation again once another instance changed it.
+    Conversations expire on their own once they are older than the maximum conversation age.
+    """
+
+    def __init__(self, url: str, max_age_minutes: int, prefix: str = 'chatgpt-telegram-bot'):
+        """
+        Connects to the Redis server at the given URL.
+        :param url: The Redis URL, e.g. redis://localhost:6379/0
+        :param max_age_minutes: The maximum age of a conversation, after which it expires
+        :param prefix: The prefix of the Redis keys
+        """
+        self.redis = redis.from_url(url)
+        self.ttl = datetime.timedelta(minutes=max_age_minutes)
+        self.prefix = prefix
+        # Writes for the same chat are serialized so that a full save can't overtake a pending append
+        self.locks = weakref.WeakValueDictionary()  # {chat_id: lock}
+        self.versions = {}  # {chat_id: version of the messages last loaded or written by this instance}
+
+    async def load(self, chat_id: int) -> dict | None:
+        async with self.__lock(chat_id):
+            pipeline = self.redis.pipeline()
+            pipeline.hgetall(self.__key(chat_id, 'state'))
+            pipeline.lrange(self.__key(chat_id, 'messages'), 0, -1)
+            state, entries = await pipeline.execute()
+            self.versions[chat_id] = int(state.get(b'version', 0))
+        if len(entries) == 0:
+            return None
+        entries = [json.loads(entry) for entry in entries]
+        last_updated = state.get(b'last_updated', b'').decode()
+        return {
+            'messages': [entry['message'] for entry in entries],
+            'tokens': [entry['tokens'] for entry in entries],
+            'is_vision': state.get(b'is_vision') == b'1',
+            'last_updated': datetime.datetime.fromisoformat(last_updated) if last_updated else None,
+        }
+
+    async def save(self, chat_id: int, conversation: dict):
+        async with self.__lock(chat_id):
+            pipeline = self.redis.pipeline()
+            pipeline.hincrby(self.__key(chat_id, 'state'), 'version', 1)
+            self.__set_state(pipeline, chat_id, conversation['is_vision'], conversation['last_updated'])
+            pipeline.delete(self.__key(chat_id, 'messages'))
+            if len(conversation['messages']) > 0:
+                pipeline.rpush(self.__key(chat_id, 'messages'), *[
+                    json.dumps({'message': message, 'tokens': tokens})
+                    for message, tokens in zip(conversation['messages'], conversation['tokens'])
+                ])
+                pipeline.expire(self.__key(chat_id, 'messages'), self.ttl)
+            # The whole conversation was replaced by this instance's copy, which is therefore up to date
+            self.versions[chat_id] = (await pipeline.execute())[0]
+
+    async def append(self, chat_id: int, message: dict, tokens: int):
+        async with self.__lock(chat_id):
+            pipeline = self.redis.pipeline()
+            pipeline.hincrby(self.__key(chat_id, 'state'), 'version', 1)
+            pipeline.rpush(self.__key(chat_id, 'messages'), json.dumps({'message': message, 'tokens': tokens}))
+            pipeline.expire(self.__key(chat_id, 'state'), self.ttl)
+            pipeline.expire(self.__key(chat_id, 'messages'), self.ttl)
+            version = (await pipeline.execute())[0]
+            # Another instance wrote in between if the version moved by more than this write
+            self.versions[chat_id] = version if self.versions.get(chat_id) == version - 1 else None
+
+    async def touch(self, chat_id: int, is_vision: bool, last_updated: datetime.datetime):
+        async with self.__lock(chat_id):
+            pipeline = self.redis.pipeline()
+            self.__set_state(pipeline, chat_id, is_vision, last_updated)
+            pipeline.expire(self.__key(chat_id, 'messages'), self.ttl)
+            await pipeline.execute()
+
+    async def delete(self, chat_id: int):
+        async with self.__lock(chat_id):
+            await self.redis.delete(self.__key(chat_id, 'state'), self.__key(chat_id, 'messages'))
+            self.versions.pop(chat_id, None)
+
+    async def is_stale(self, chat_id: int) -> bool:
+        async with self.__lock(chat_id):
+            version = await self.redis.hget(self.__key(chat_id, 'state'), 'version')
+            return int(version or 0) != self.versions.get(chat_id)
+
+    def __set_state(self, pipeline, chat_id: int, is_vision: bool, last_updated: datetime.datetime | None):
+        pipeline.hset(self.__key(chat_id, 'state'), mapping={
+            'is_vision': '1' if is_vision else '0',
+            'last_updated': last_updated.isoformat() if last_updated else '',
+        })
+        pipeline.expire(self.__key(chat_id, 'state'), self.ttl)
+
+    def __key(self, chat_id: int, name: str) -> str:
+        return f'{self.prefix}:conversation:{chat_id}:{name}'
+
+    def __lock(self, chat_id: int) -> asyncio.Lock:
+        lock = self.locks.get(chat_id)
+        if lock is None:
+            lock = self.locks[chat_id] = asyncio.Lock()
+        return lock
+
+
+def create_conversation_store(config: dict) -> ConversationStore:
+    """
+    Creates the conversation store configured by the `conversation_store` setting.
+    :param config: A dictionary containing the GPT configuration
+    :return: The conversation store
+    """
+    store = config.get('conversation_store', 'memory')
+    if store == 'memory':
+        return MemoryConversationStore()
+    if store == 'sqlite':
+        logging.info(f'Storing conversations in SQLite database {config["conversation_store_path"]}')
+        return SQLiteConversationStore(config['conversation_store_path'])
+    if store == 'redis':
+        logging.info('Storing conversations in Redis')
+        return RedisConversationStore(config['redis_url'], config['max_conversation_age_minutes'])
+    raise ValueError(f'Unknown conversation store: {store}')
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import asyncio
+import weakref
+
+import httpx
+
+
+class HostSlotStream(httpx.AsyncByteStream):
+    """
+    The body of a response, which releases the slot of the response's host once it is closed.
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, semaphore: asyncio.Semaphore):
+        self.stream = stream
+        self.semaphore = semaphore
+        self.closed = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            await self.stream.aclose()
+        finally:
+            self.semaphore.release()
+
+
+class HostLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    A transport that limits the number of concurrent requests to each host, on top of the limits of the
+    connection pool, so that a slow third-party API can't take up all the connections of the pool.
+    A request keeps its host's slot until its response is closed, which the client does once the body is read,
+    so responses may be streamed, and a streamed response must be closed to release the slot.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, max_connections_per_host: int):
+        """
+        Initializes the transport.
+        :param transport: The transport sending the requests
+        :param max_connections_per_host: The maximum number of concurrent requests to a single host
+        """
+        self.transport = transport
+        self.max_connections_per_host = max_connections_per_host
+        # Only the hosts with requests in flight or waiting keep their semaphore
+        self.semaphores = weakref.WeakValueDictionary()  # {host: semaphore}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        semaphore = self.semaphores.get(request.url.host)
+        if semaphore is None:
+            semaphore = self.semaphores[request.url.host] = asyncio.Semaphore(self.max_connections_per_host)
+        await semaphore.acquire()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            semaphore.release()
+            raise
+        response.stream = HostSlotStream(response.stream, semaphore)
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+def create_http_client(max_connections: int = 100, max_keepalive_connections: int = 20,
+                       max_connections_per_host: int = 10, timeout: float = 15.0,
+                       connect_timeout: float = 5.0) -> httpx.AsyncClient:
+    """
+    Creates an HTTP client with a pool of keep-alive connections, to be shared by all plugins.
+    :param max_connections: The maximum number of concurrent connections
+    :param max_keepalive_connections: The maximum number of idle connections kept alive
+    :param max_connections_per_host: The maximum number of concurrent requests to a single host
+    :param timeout: The default number of seconds to wait for reading, writing or a free connection
+    :param connect_timeout: The default number of seconds to wait for a connection to be established
+    :return: The HTTP client
+    """
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+    transport = HostLimitedTransport(httpx.AsyncHTTPTransport(limits=limits), max_connections_per_host)
+    return httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(timeout, connect=connect_timeout),
+                             follow_redirects=True)
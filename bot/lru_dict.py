@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import sys
+import time
+from collections import OrderedDict
+
+
+class LRUDict(OrderedDict):
+    """
+    A dictionary that keeps its keys ordered from least to most recently used and remembers
+    when each key was last read or written, so that stale entries can be evicted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.accessed_at: dict = {}  # {key: monotonic timestamp of the last access}
+        super().__init__(*args, **kwargs)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.__touch(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.__touch(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.accessed_at.pop(key, None)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *args):
+        self.accessed_at.pop(key, None)
+        return super().pop(key, *args)
+
+    def popitem(self, last=True):
+        key, value = super().popitem(last)
+        self.accessed_at.pop(key, None)
+        return key, value
+
+    def clear(self):
+        super().clear()
+        self.accessed_at.clear()
+
+    def peek(self, key):
+        """
+        Returns the value of the given key without marking it as used.
+        """
+        return super().__getitem__(key)
+
+    def idle_seconds(self, key) -> float:
+        """
+        Returns the number of seconds since the given key was last accessed.
+        """
+        return time.monotonic() - self.accessed_at[key]
+
+    def evict_idle(self, max_idle_seconds: float, keep: set = frozenset()) -> int:
+        """
+        Removes all entries that were not accessed in the given number of seconds.
+        :param max_idle_seconds: The maximum number of seconds an entry may stay unused
+        :param keep: The keys that are never evicted, however long they stay unused
+        :return: The number of evicted entries
+        """
+        evicted = 0
+        for key in list(self):
+            if self.idle_seconds(key) <= max_idle_seconds:
+                break
+            if key in keep:
+                continue
+            self.pop(key)
+            evicted += 1
+        return evicted
+
+    def __touch(self, key):
+        self.move_to_end(key)
+        self.accessed_at[key] = time.monotonic()
+
+
+def estimate_size(value) -> int:
+    """
+    Roughly estimates the number of bytes held by the given value, counting the characters of strings
+    and recursing into dictionaries, lists, tuples and the attributes of objects.
+    """
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(item) for item in value)
+    if hasattr(value, '__dict__'):
+        return estimate_size(vars(value))
+    return sys.getsizeof(value)
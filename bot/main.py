@@ -4,6 +4,7 @@ import os
 from dotenv import load_dotenv
 
 from plugin_manager import PluginManager
+from conversation_store import create_conversation_store
 from openai_helper import OpenAIHelper, default_max_tokens, are_functions_available
 from telegram_bot import ChatGPTTelegramBot
 
@@ -34,9 +35,19 @@ def main():
         'api_key': os.environ['OPENAI_API_KEY'],
         'show_usage': os.environ.get('SHOW_USAGE', 'false').lower() == 'true',
         'stream': os.environ.get('STREAM', 'true').lower() == 'true',
+        'stream_usage': os.environ.get('STREAM_USAGE', 'true').lower() == 'true',
         'proxy': os.environ.get('PROXY', None) or os.environ.get('OPENAI_PROXY', None),
         'max_history_size': int(os.environ.get('MAX_HISTORY_SIZE', 15)),
         'max_conversation_age_minutes': int(os.environ.get('MAX_CONVERSATION_AGE_MINUTES', 180)),
+        'history_strategy': os.environ.get('HISTORY_STRATEGY', 'summarise').lower(),
+        'background_summarisation': os.environ.get('BACKGROUND_SUMMARISATION', 'true').lower() == 'true',
+        'summarisation_soft_limit': float(os.environ.get('SUMMARISATION_SOFT_LIMIT', 0.75)),
+        'conversation_store': os.environ.get('CONVERSATION_STORE', 'memory').lower(),
+        'conversation_store_path': os.environ.get('CONVERSATION_STORE_PATH', 'conversations.db'),
+        'redis_url': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+        'response_cache': os.environ.get('RESPONSE_CACHE', 'auto').lower(),
+        'response_cache_ttl_seconds': int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', 3600)),
+        'response_cache_max_size': int(os.environ.get('RESPONSE_CACHE_MAX_SIZE', 1000)),
         'assistant_prompt': os.environ.get('ASSISTANT_PROMPT', 'You are a helpful assistant.'),
         'max_tokens': int(os.environ.get('MAX_TOKENS', max_tokens_default)),
         'n_choices': int(os.environ.get('N_CHOICES', 1)),
@@ -48,6 +59,7 @@ def main():
         'model': model,
         'enable_functions': os.environ.get('ENABLE_FUNCTIONS', str(functions_available)).lower() == 'true',
         'functions_max_consecutive_calls': int(os.environ.get('FUNCTIONS_MAX_CONSECUTIVE_CALLS', 10)),
+        'functions_max_parallel_calls': int(os.environ.get('FUNCTIONS_MAX_PARALLEL_CALLS', 4)),
         'presence_penalty': float(os.environ.get('PRESENCE_PENALTY', 0.0)),
         'frequency_penalty': float(os.environ.get('FREQUENCY_PENALTY', 0.0)),
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
@@ -66,6 +78,18 @@ def main():
         logging.error(f'ENABLE_FUNCTIONS is set to true, but the model {model} does not support it. '
                         f'Please set ENABLE_FUNCTIONS to false or use a model that supports it.')
         exit(1)
+    if openai_config['history_strategy'] not in ('summarise', 'window'):
+        logging.error(f'HISTORY_STRATEGY must be either summarise or window, '
+                      f'got {openai_config["history_strategy"]} instead.')
+        exit(1)
+    if openai_config['conversation_store'] not in ('memory', 'sqlite', 'redis'):
+        logging.error(f'CONVERSATION_STORE must be one of memory, sqlite or redis, '
+                      f'got {openai_config["conversation_store"]} instead.')
+        exit(1)
+    if openai_config['response_cache'] not in ('auto', 'always', 'off'):
+        logging.error(f'RESPONSE_CACHE must be one of auto, always or off, '
+                      f'got {openai_config["response_cache"]} instead.')
+        exit(1)
     if os.environ.get('MONTHLY_USER_BUDGETS') is not None:
         logging.warning('The environment variable MONTHLY_USER_BUDGETS is deprecated. '
                         'Please use USER_BUDGETS with BUDGET_PERIOD instead.')
@@ -100,15 +124,23 @@ def main():
         'tts_prices': [float(i) for i in os.environ.get('TTS_PRICES', "0.015,0.030").split(",")],
         'transcription_price': float(os.environ.get('TRANSCRIPTION_PRICE', 0.006)),
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
+        'max_conversation_age_minutes': int(os.environ.get('MAX_CONVERSATION_AGE_MINUTES', 180)),
+        'memory_sweep_interval_seconds': int(os.environ.get('MEMORY_SWEEP_INTERVAL_SECONDS', 300)),
+        'max_memory_mb': int(os.environ.get('MAX_MEMORY_MB', 0)),
+        'message_debounce_seconds': float(os.environ.get('MESSAGE_DEBOUNCE_SECONDS', 0.0)),
+        'stop_on_new_message': os.environ.get('STOP_ON_NEW_MESSAGE', 'false').lower() == 'true',
     }
 
     plugin_config = {
-        'plugins': os.environ.get('PLUGINS', '').split(',')
+        'plugins': os.environ.get('PLUGINS', '').split(','),
+        'plugin_cache_max_size': int(os.environ.get('PLUGIN_CACHE_MAX_SIZE', 1000)),
     }
 
     # Setup and run ChatGPT and Telegram bot
     plugin_manager = PluginManager(config=plugin_config)
-    openai_helper = OpenAIHelper(config=openai_config, plugin_manager=plugin_manager)
+    conversation_store = create_conversation_store(config=openai_config)
+    openai_helper = OpenAIHelper(config=openai_config, plugin_manager=plugin_manager,
+                                 conversation_store=conversation_store)
     telegram_bot = ChatGPTTelegramBot(config=telegram_config, openai=openai_helper)
     telegram_bot.run()
 
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import re
+
+FENCE_PATTERN = re.compile(r'^ {0,3}```\s*(\S*)')
+
+
+class MessageSplitter:
+    """
+    Splits a markdown answer into chunks that fit into Telegram messages.
+    Chunks end at paragraph or line boundaries where possible, and code blocks that span several chunks are
+    closed at the end of a chunk and reopened at the start of the next one.
+    The splitter can be fed a growing answer (a string or a StreamBuffer) during streaming:
+    it only scans the text that was added since the previous call.
+    """
+
+    def __init__(self, max_length: int = 4096):
+        """
+        Initializes the splitter.
+        :param max_length: The maximum length of a chunk
+        """
+        self.max_length = max_length
+        self.start = 0  # the offset of the current chunk in the answer
+        self.prefix = ''  # the fence reopening a code block at the start of the current chunk
+        self.scanned = 0  # the offset up to which complete lines were scanned for fences
+        self.fences = []  # the (offset, language) of the fence lines after the start of the current chunk
+        self.language = None  # the language of the code block open at the scanned offset, None if there is none
+
+    def split(self, text) -> list[str]:
+        """
+        Splits off the chunks of the answer that are complete, i.e. that the answer has outgrown.
+        :param text: The answer so far, either a string or a StreamBuffer
+        :return: The chunks completed since the previous call
+        """
+        chunks = []
+        while len(self.prefix) + len(text) - self.start > self.max_length:
+            chunks.append(self.__split_off(text))
+        return chunks
+
+    def current(self, text) -> str:
+        """
+        Returns the current (last) chunk of the answer.
+        :param text: The answer so far, either a string or a StreamBuffer
+        """
+        return self.prefix + text[self.start:len(text)]
+
+    def __scan(self, text):
+        """
+        Records the fence lines among the complete lines added since the last scan.
+        """
+        end = len(text)
+        if end <= self.scanned:
+            return
+        new_text = text[self.scanned:end]
+        last_newline = new_text.rfind('\n')
+        if last_newline < 0:
+            return
+        offset = self.scanned
+        for line in new_text[:last_newline].split('\n'):
+            match = FENCE_PATTERN.match(line)
+            if match:
+                self.language = None if self.language is not None else match.group(1)
+                self.fences.append((offset, self.language))
+            offset += len(line) + 1
+        self.scanned += last_newline + 1
+
+    def __language_at(self, offset: int) -> str | None:
+        """
+        Returns the language of the code block open at the given offset of the current chunk,
+        or None if the offset is outside of a code block.
+        """
+        language = self.prefix[3:-1] if self.prefix else None
+        for fence_offset, fence_language in self.fences:
+            if fence_offset >= offset:
+                break
+            language = fence_language
+        return language
+
+    def __split_off(self, text) -> str:
+        """
+        Splits the first chunk off the current chunk, preferably at a paragraph or line boundary.
+        Room for the fence closing a code block is only reserved if the chunk ends inside of one.
+        """
+        self.__scan(text)
+        budget = self.max_length - len(self.prefix)
+        cut, chunk = self.__cut(text, budget)
+        language = self.__language_at(cut)
+        if language is not None and len(chunk) + len('\n```') > self.max_length:
+            cut, chunk = self.__cut(text, budget - len('\n```'))
+            language = self.__language_at(cut)
+        if language is not None:
+            chunk += '\n```'
+        self.prefix = f'```{language}\n' if language is not None else ''
+        self.fences = [fence for fence in self.fences if fence[0] >= cut]
+        self.start = cut
+        return chunk
+
+    def __cut(self, text, budget: int) -> tuple[int, str]:
+        """
+        Finds where to end the first chunk of the given length at most.
+        :return: The offset of the end of the chunk in the answer, and the chunk without a closing fence
+        """
+        window = text[self.start:self.start + budget]
+        cut = len(window)
+        for separator in ('\n\n', '\n', ' '):
+            position = window.rfind(separator)
+            if position >= budget // 2:
+                cut = position + len(separator)
+                break
+        return self.start + cut, self.prefix + window[:cut].rstrip()
@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+from lru_dict import LRUDict
+
+
+class MessageStates:
+    """
+    Remembers the last text and parse mode sent for the most recently edited messages, so that edits that
+    wouldn't change a message are dropped locally instead of costing a request that Telegram answers
+    with "Message is not modified".
+    """
+
+    def __init__(self, max_size: int = 1000):
+        """
+        Initializes the message states.
+        :param max_size: The maximum number of messages to remember
+        """
+        self.max_size = max_size
+        self.states = LRUDict()  # {(chat_id, message_id): {'text': ..., 'parse_mode': ..., 'rejected_text': ...}}
+        self.suppressed_edits = 0
+
+    def get(self, message_key: tuple) -> dict:
+        """
+        Returns the state of the given message, remembering it as the most recently edited one.
+        """
+        state = self.states.get(message_key)
+        if state is None:
+            state = self.states[message_key] = {'text': None, 'parse_mode': None, 'rejected_text': None}
+            while len(self.states) > self.max_size:
+                self.states.popitem(last=False)
+        return state
+
+    def is_unchanged(self, message_key: tuple, text: str, parse_mode) -> bool:
+        """
+        Whether the message already shows the given text with the given parse mode,
+        in which case the edit is counted as suppressed.
+        """
+        state = self.get(message_key)
+        if state['text'] == text and state['parse_mode'] == parse_mode:
+            self.suppressed_edits += 1
+            return True
+        return False
+
+    def record(self, message_key: tuple, text: str, parse_mode):
+        """
+        Records the text and parse mode the message shows after a successful edit.
+        """
+        state = self.get(message_key)
+        state['text'], state['parse_mode'] = text, parse_mode
+
+    def __len__(self) -> int:
+        return len(self.states)
@@ -1,10 +1,9 @@
 from __future__ import annotations
+import asyncio
+import bisect
 import datetime
 import logging
 import os
-import pprint
-
-import tiktoken
 
 import openai
 
@@ -20,6 +19,12 @@ from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_t
 
 from utils import is_direct_result, encode_image, decode_image
 from plugin_manager import PluginManager
+from conversation_store import ConversationStore, MemoryConversationStore
+from lru_dict import LRUDict, estimate_size
+from response_cache import ResponseCache
+from single_flight import SingleFlight, close_stream
+from stream_buffer import StreamBuffer
+from tokenizer import Tokenizer
 
 # Models can be found here: https://platform.openai.com/docs/models/overview
 # Models gpt-3.5-turbo-0613 and  gpt-3.5-turbo-16k-0613 will be deprecated on June 13, 2024
@@ -103,21 +108,33 @@ class OpenAIHelper:
     ChatGPT helper class.
     """
 
-    def __init__(self, config: dict, plugin_manager: PluginManager):
+    def __init__(self, config: dict, plugin_manager: PluginManager, conversation_store: ConversationStore = None):
         """
         Initializes the OpenAI helper class with the given configuration.
         :param config: A dictionary containing the GPT configuration
         :param plugin_manager: The plugin manager
+        :param conversation_store: The store persisting the conversations, in memory only by default
         """
         http_client = httpx.AsyncClient(proxies=config['proxy']) if 'proxy' in config else None
         self.client = openai.AsyncOpenAI(api_key=config['api_key'], http_client=http_client)
         self.config = config
         self.plugin_manager = plugin_manager
-        self.conversations: dict[int: list] = {}  # {chat_id: history}
+        self.tokenizer = Tokenizer()
+        self.store = conversation_store or MemoryConversationStore()
+        self.conversations: LRUDict[int: list] = LRUDict()  # {chat_id: history}, least recently used first
         self.conversations_vision: dict[int: bool] = {}  # {chat_id: is_vision}
         self.last_updated: dict[int: datetime] = {}  # {chat_id: last_update_timestamp}
-
-    def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
+        self.conversations_tokens: dict[int: list] = {}  # {chat_id: cumulative token count per message}
+        self.conversations_images: dict[int: dict] = {}  # {chat_id: {image_url: image_metadata}}
+        self.summarisation_tasks: dict[int: asyncio.Task] = {}  # {chat_id: background_summarisation_task}
+        self.response_cache = ResponseCache(mode=config['response_cache'],
+                                            ttl_seconds=config['response_cache_ttl_seconds'],
+                                            max_size=config['response_cache_max_size']) \
+            if config['response_cache'] != 'off' else None
+        self.single_flight = SingleFlight()
+        self.stopped_tokens: dict[int: int] = {}  # {chat_id: tokens used by the last stopped stream}
+
+    async def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
         """
         Returns the statistics of a conversation in terms of number of messages and number of tokens.
 
@@ -128,9 +145,10 @@ class OpenAIHelper:
         - tuple[int, int]: A tuple containing the number of messages and number of tokens in the conversation.
 
         """
+        await self.__load_conversation(chat_id)
         if chat_id not in self.conversations:
-            self.reset_chat_history(chat_id)
-        return len(self.conversations[chat_id]), self.__count_tokens(self.conversations[chat_id])
+            await self.reset_chat_history(chat_id)
+        return len(self.conversations[chat_id]), self.__conversation_tokens(chat_id)
 
     async def get_chat_response(self, chat_id: int, query: str) -> tuple[str, str]:
         """
@@ -162,13 +180,14 @@ class OpenAIHelper:
             for index, choice in enumerate(response.choices):
                 content = choice.message.content.strip()
                 if index == 0:
-                    self.__add_to_history(chat_id, role="assistant", content=content)
+                    await self.__add_to_history(chat_id, role="assistant", content=content)
                 answer += f'{index + 1}\u20e3\n'
                 answer += content
                 answer += '\n\n'
         else:
             answer = response.choices[0].message.content.strip()
-            self.__add_to_history(chat_id, role="assistant", content=answer)
+            await self.__add_to_history(chat_id, role="assistant", content=answer)
+        self.__schedule_background_summarisation(chat_id)
 
         bot_language = self.config['bot_language']
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
@@ -198,12 +217,13 @@ class OpenAIHelper:
         - query (str): The query sent by the user.
 
         Returns:
-        - Generator[Tuple[str, str]]: A generator that yields tuples containing the chat response
-          and the number of tokens used. Each tuple represents a chat response.
+        - Generator[Tuple[StreamBuffer, str]]: A generator that yields tuples containing the buffer of the
+          chat response so far and the number of tokens used ('not_finished' until the response is complete).
+          The same buffer is yielded for every delta, the last tuple holds a new buffer with the final answer.
 
         Example usage:
         async for response, tokens_used in bot.get_chat_response_stream(chat_id, query):
-            print(response)
+            print(response.delta)
             print(f"Tokens used: {tokens_used}")
         """
         plugins_used = ()
@@ -214,17 +234,15 @@ class OpenAIHelper:
                 yield response, '0'
                 return
 
-        answer = ''
-        async for chunk in response:
-            if len(chunk.choices) == 0:
-                continue
-            delta = chunk.choices[0].delta
-            if delta.content:
-                answer += delta.content
-                yield answer, 'not_finished'
-        answer = answer.strip()
-        self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        buffer = StreamBuffer()
+        usage = None
+        async for usage in self.__read_stream(chat_id, response, buffer):
+            if usage is None:
+                yield buffer, 'not_finished'
+        answer = str(buffer).rstrip()
+        await self.__add_to_history(chat_id, role="assistant", content=answer)
+        tokens_used = self.__stream_tokens_used(chat_id, response, usage)
+        self.__schedule_background_summarisation(chat_id)
 
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
@@ -235,7 +253,56 @@ class OpenAIHelper:
         elif show_plugins_used:
             answer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
 
-        yield answer, tokens_used
+        yield StreamBuffer(answer), tokens_used
+
+    async def __read_stream(self, chat_id: int, response, buffer: StreamBuffer):
+        """
+        Appends the deltas of a streamed response to the buffer, yielding None after each of them,
+        and the usage reported by the last chunk, if the API sends it.
+        If reading is cancelled, e.g. because the user stopped the answer, the stream is closed right away
+        so that OpenAI stops generating, the partial answer is kept in the history,
+        and the tokens used so far are left in `stopped_tokens` to be billed.
+        """
+        try:
+            async for chunk in response:
+                if getattr(chunk, 'usage', None) is not None:
+                    yield chunk.usage
+                if len(chunk.choices) == 0:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    buffer.append(delta.content)
+                    yield None
+        except (asyncio.CancelledError, GeneratorExit):
+            await close_stream(response)
+            answer = str(buffer).rstrip()
+            if answer:
+                # A second cancellation must not interrupt the history update either
+                await asyncio.shield(self.__add_to_history(chat_id, role="assistant", content=answer))
+            self.stopped_tokens[chat_id] = 0 if getattr(response, 'reused', False) \
+                else self.__conversation_tokens(chat_id)
+            logging.info(f'Stopped streaming the answer in chat {chat_id} after {len(answer)} characters')
+            raise
+
+    def __stream_tokens_used(self, chat_id: int, response, usage) -> str:
+        """
+        Returns the number of tokens a finished stream used, as reported by the API in its last chunk.
+        Falls back to the tokens of the conversation according to the token ledger, if the API didn't report them.
+        Streams shared with an identical request or replayed from the cache didn't use any tokens.
+        """
+        if getattr(response, 'reused', False):
+            return '0'
+        if usage is not None:
+            return str(usage.total_tokens)
+        return str(self.__conversation_tokens(chat_id))
+
+    def pop_stopped_tokens(self, chat_id: int) -> int:
+        """
+        Returns the number of tokens used by the last stopped stream of the given chat, and forgets it.
+        :param chat_id: The chat ID
+        :return: The number of tokens, 0 if no stream was stopped
+        """
+        return self.stopped_tokens.pop(chat_id, 0)
 
     @retry(
         reraise=True,
@@ -270,34 +337,39 @@ class OpenAIHelper:
           The summary is added to the chat history and the original user's message/query is retained.
         - The common arguments for the OpenAI Chat API request are determined based on the configuration settings.
         - If function plugins are enabled and there are available function specifications,
-          the common arguments include the function specs and the function call option is set to 'auto'.
+          the common arguments include the tool specs and the tool choice option is set to 'auto'.
 
         """
         bot_language = self.config['bot_language']
         try:
+            await self.__load_conversation(chat_id)
             if chat_id not in self.conversations or self.__max_age_reached(chat_id):
-                self.reset_chat_history(chat_id)
+                await self.reset_chat_history(chat_id)
 
-            self.last_updated[chat_id] = datetime.datetime.now()
+            await self.__touch(chat_id)
 
-            self.__add_to_history(chat_id, role="user", content=query)
+            await self.__add_to_history(chat_id, role="user", content=query)
 
-            # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
+            if self.config['history_strategy'] == 'window':
+                # Drop the oldest messages that no longer fit, without any extra API call
+                await self.__trim_history_window(chat_id)
 
-            if exceeded_max_tokens or exceeded_max_history_size:
+            elif chat_id in self.summarisation_tasks and self.__history_exceeds_limit(chat_id):
+                # A summary is already being generated in the background, wait for it instead of starting another
+                await asyncio.shield(self.summarisation_tasks[chat_id])
+
+            # Summarize the chat history if it's too long to avoid excessive token usage
+            if self.config['history_strategy'] == 'summarise' and self.__history_exceeds_limit(chat_id):
                 logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
                 try:
                     summary = await self.__summarise(self.conversations[chat_id][:-1])
                     logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.__add_to_history(chat_id, role="user", content=query)
+                    await self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
+                    await self.__add_to_history(chat_id, role="assistant", content=summary)
+                    await self.__add_to_history(chat_id, role="user", content=query)
                 except Exception as e:
                     logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+                    await self.__truncate_history(chat_id, self.config['max_history_size'])
 
             common_args = {
                 'model': self.config['model'] if not self.conversations_vision[chat_id] else self.config['vision_model'],
@@ -311,12 +383,12 @@ class OpenAIHelper:
             }
 
             if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-                functions = self.plugin_manager.get_functions_specs_functions()
-                if len(functions) > 0:
-                    common_args['functions'] = self.plugin_manager.get_functions_specs_functions()
-                    common_args['function_call'] = 'auto'
+                tools = self.plugin_manager.get_functions_specs_tools()
+                if len(tools) > 0:
+                    common_args['tools'] = tools
+                    common_args['tool_choice'] = 'auto'
 
-            return await self.client.chat.completions.create(**common_args)
+            return await self.__create_chat_completion(**common_args)
 
         except openai.RateLimitError as e:
             raise e
@@ -329,7 +401,7 @@ class OpenAIHelper:
 
     async def __handle_function_call(self, chat_id, response, stream=False, times=0, plugins_used=()):
         """
-        Handles the function call from the given response.
+        Handles the tool calls from the given response, calling their functions concurrently.
 
         Parameters:
         - chat_id: The ID of the chat.
@@ -339,25 +411,20 @@ class OpenAIHelper:
         - plugins_used: A tuple containing the names of the plugins already used. Default is an empty tuple.
 
         Returns:
-        - The response and plugins_used tuple if the function call is not present in the response or if there are no choices in the response.
-        - The function_response and plugins_used tuple if the function call is successful and returns a direct result.
-        - The function_response and plugins_used tuple if the function call is successful but does not return a direct result.
+        - The response and plugins_used tuple if no tool call is present in the response or if there are no choices in the response.
+        - The function_response and plugins_used tuple if a function call returns a direct result.
         - Calls the __handle_function_call method recursively with updated parameters.
 
         Docstring Examples:
         """
-        function_name = ''
-        arguments = ''
+        tool_calls = []
         if stream:
             async for item in response:
                 if len(item.choices) > 0:
                     first_choice = item.choices[0]
-                    if first_choice.delta and first_choice.delta.function_call:
-                        if first_choice.delta.function_call.name:
-                            function_name += first_choice.delta.function_call.name
-                        if first_choice.delta.function_call.arguments:
-                            arguments += first_choice.delta.function_call.arguments
-                    elif first_choice.finish_reason and first_choice.finish_reason == 'function_call':
+                    if first_choice.delta and first_choice.delta.tool_calls:
+                        self.__merge_tool_call_deltas(tool_calls, first_choice.delta.tool_calls)
+                    elif first_choice.finish_reason and first_choice.finish_reason == 'tool_calls':
                         break
                     else:
                         return response, plugins_used
@@ -366,30 +433,32 @@ class OpenAIHelper:
         else:
             if len(response.choices) > 0:
                 first_choice = response.choices[0]
-                if first_choice.message.function_call:
-                    if first_choice.message.function_call.name:
-                        function_name += first_choice.message.function_call.name
-                    if first_choice.message.function_call.arguments:
-                        arguments += first_choice.message.function_call.arguments
+                if first_choice.message.tool_calls:
+                    tool_calls = [tool_call.model_dump(include={'id', 'type', 'function'})
+                                  for tool_call in first_choice.message.tool_calls]
                 else:
                     return response, plugins_used
             else:
                 return response, plugins_used
 
-        logging.info(f'Calling function {function_name} with arguments {arguments}')
-        function_response = await self.plugin_manager.call_function(function_name, self, arguments)
-
-        if function_name not in plugins_used:
-            plugins_used += (function_name,)
-
-        if is_direct_result(function_response):
-            self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name,
-                                                content=json.dumps({'result': 'Done, the content has been sent'
-                                                                              'to the user.'}))
-            return function_response, plugins_used
-
-        self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name, content=function_response)
-        response = await self.client.chat.completions.create(
+        function_responses = await self.__call_functions(tool_calls)
+        for tool_call in tool_calls:
+            if tool_call['function']['name'] not in plugins_used:
+                plugins_used += (tool_call['function']['name'],)
+
+        direct_result = next((function_response for function_response in function_responses
+                              if is_direct_result(function_response)), None)
+        messages = [{"role": "assistant", "content": None, "tool_calls": tool_calls}]
+        for tool_call, function_response in zip(tool_calls, function_responses):
+            if is_direct_result(function_response):
+                function_response = json.dumps({'result': 'Done, the content has been sent to the user.'})
+            messages.append({"role": "tool", "tool_call_id": tool_call['id'], "content": function_response})
+        # The API rejects a tool call without all of its results, so they are added to the history together
+        await self.__append_messages_to_history(chat_id, messages)
+        if direct_result is not None:
+            return direct_result, plugins_used
+
+        response = await self.__create_chat_completion(
             model=self.config['model'],
             messages=self.conversations[chat_id],
             tools=self.plugin_manager.get_functions_specs_tools(),
@@ -398,6 +467,79 @@ class OpenAIHelper:
         )
         return await self.__handle_function_call(chat_id, response, stream, times + 1, plugins_used)
 
+    async def __call_functions(self, tool_calls: list[dict]) -> list[str]:
+        """
+        Calls the functions of the given tool calls concurrently, at most `functions_max_parallel_calls` at a time.
+        :param tool_calls: The tool calls requested by the model
+        :return: The responses of the functions, in the order of the tool calls
+        """
+        semaphore = asyncio.Semaphore(self.config['functions_max_parallel_calls'])
+
+        async def call_function(tool_call):
+            function_name, arguments = tool_call['function']['name'], tool_call['function']['arguments']
+            async with semaphore:
+                logging.info(f'Calling function {function_name} with arguments {arguments}')
+                return await self.plugin_manager.call_function(function_name, self, arguments)
+
+        return await asyncio.gather(*(call_function(tool_call) for tool_call in tool_calls))
+
+    @staticmethod
+    def __merge_tool_call_deltas(tool_calls: list[dict], deltas):
+        """
+        Appends the streamed deltas of tool calls to the assembled tool calls, by their index.
+        """
+        for delta in deltas:
+            while len(tool_calls) <= delta.index:
+                tool_calls.append({'id': '', 'type': 'function', 'function': {'name': '', 'arguments': ''}})
+            tool_call = tool_calls[delta.index]
+            tool_call['id'] += delta.id or ''
+            if delta.function:
+                tool_call['function']['name'] += delta.function.name or ''
+                tool_call['function']['arguments'] += delta.function.arguments or ''
+
+    async def __create_chat_completion(self, **args):
+        """
+        Requests a chat completion, serving it from the response cache if an identical request was answered before,
+        or sharing the result of an identical request that is still in flight.
+        Reused responses have a usage of zero tokens, reused streams are marked with `reused`.
+        :param args: The arguments of the chat completion request
+        :return: The chat completion, or the stream of chunks if `stream` is set
+        """
+        if args.get('stream', False) and self.config['stream_usage']:
+            # Let the last chunk of the stream report the tokens used
+            args['stream_options'] = {'include_usage': True}
+        key = ResponseCache.key(args)
+        cacheable = self.response_cache is not None and self.response_cache.is_cacheable(args)
+        if cacheable:
+            choices = self.response_cache.get(key)
+            if choices is not None:
+                logging.info('Serving chat completion from the response cache')
+                if args.get('stream', False):
+                    return self.response_cache.to_stream(choices, args['model'])
+                return self.response_cache.to_completion(choices, args['model'])
+
+        if args.get('stream', False):
+            async def open_stream():
+                response = await self.client.chat.completions.create(**args)
+                return self.response_cache.record_stream(key, response) if cacheable else response
+
+            stream = await self.single_flight.stream(key, open_stream)
+            if stream.reused:
+                logging.info('Sharing the stream of an identical chat completion in flight')
+            return stream
+
+        async def complete():
+            response = await self.client.chat.completions.create(**args)
+            if cacheable:
+                self.response_cache.put_completion(key, response)
+            return response
+
+        response, shared = await self.single_flight.call(key, complete)
+        if shared:
+            logging.info('Sharing the result of an identical chat completion in flight')
+            return ResponseCache.to_completion(ResponseCache.choices(response), args['model'])
+        return response
+
     async def generate_image(self, prompt: str) -> tuple[str, str]:
         """
         Generates an image from the given prompt using DALL·E model.
@@ -467,48 +609,62 @@ class OpenAIHelper:
         wait=wait_fixed(20),
         stop=stop_after_attempt(3)
     )
-    async def __common_get_chat_response_vision(self, chat_id: int, content: list, stream=False):
+    async def __common_get_chat_response_vision(self, chat_id: int, content: list, image_metadata: dict,
+                                                stream=False):
         """
         Request a response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
+        :param image_metadata: The width, height and token cost of the image in the query, if kept in the history
         :return: The answer from the model and the number of tokens used
         """
         bot_language = self.config['bot_language']
         try:
+            await self.__load_conversation(chat_id)
             if chat_id not in self.conversations or self.__max_age_reached(chat_id):
-                self.reset_chat_history(chat_id)
-
-            self.last_updated[chat_id] = datetime.datetime.now()
+                await self.reset_chat_history(chat_id)
 
             if self.config['enable_vision_follow_up_questions']:
                 self.conversations_vision[chat_id] = True
-                self.__add_to_history(chat_id, role="user", content=content)
+            await self.__touch(chat_id)
+
+            if self.config['enable_vision_follow_up_questions']:
+                for image_url in self.__image_urls(content):
+                    self.conversations_images[chat_id][image_url] = image_metadata
+                await self.__add_to_history(chat_id, role="user", content=content)
             else:
                 for message in content:
                     if message['type'] == 'text':
                         query = message['text']
                         break
-                self.__add_to_history(chat_id, role="user", content=query)
+                await self.__add_to_history(chat_id, role="user", content=query)
 
-            # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
+            if self.config['history_strategy'] == 'window':
+                # Drop the oldest messages that no longer fit, without any extra API call
+                await self.__trim_history_window(chat_id)
+
+            elif chat_id in self.summarisation_tasks and self.__history_exceeds_limit(chat_id):
+                # A summary is already being generated in the background, wait for it instead of starting another
+                await asyncio.shield(self.summarisation_tasks[chat_id])
 
-            if exceeded_max_tokens or exceeded_max_history_size:
+            # Summarize the chat history if it's too long to avoid excessive token usage
+            if self.config['history_strategy'] == 'summarise' and self.__history_exceeds_limit(chat_id):
                 logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
                 try:
                     
                     last = self.conversations[chat_id][-1]
+                    last_tokens = self.conversations_tokens[chat_id][-1] - self.conversations_tokens[chat_id][-2]
+                    images = self.conversations_images[chat_id]
                     summary = await self.__summarise(self.conversations[chat_id][:-1])
                     logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.conversations[chat_id] += [last]
+                    await self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
+                    for image_url in self.__image_urls(last['content']):
+                        self.conversations_images[chat_id][image_url] = images[image_url]
+                    await self.__add_to_history(chat_id, role="assistant", content=summary)
+                    await self.__append_to_history(chat_id, last, last_tokens)
                 except Exception as e:
                     logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+                    await self.__truncate_history(chat_id, self.config['max_history_size'])
 
             message = {'role':'user', 'content':content}
 
@@ -532,7 +688,7 @@ class OpenAIHelper:
             #         common_args['functions'] = self.plugin_manager.get_functions_specs()
             #         common_args['function_call'] = 'auto'
             
-            return await self.client.chat.completions.create(**common_args)
+            return await self.__create_chat_completion(**common_args)
 
         except openai.RateLimitError as e:
             raise e
@@ -549,12 +705,13 @@ class OpenAIHelper:
         Interprets a given PNG image file using the Vision model.
         """
         image = encode_image(fileobj)
+        image_metadata = self.__image_metadata(fileobj) if self.config['enable_vision_follow_up_questions'] else None
         prompt = self.config['vision_prompt'] if prompt is None else prompt
 
         content = [{'type':'text', 'text':prompt}, {'type':'image_url', \
                     'image_url': {'url':image, 'detail':self.config['vision_detail'] } }]
 
-        response = await self.__common_get_chat_response_vision(chat_id, content)
+        response = await self.__common_get_chat_response_vision(chat_id, content, image_metadata)
 
         
 
@@ -571,13 +728,14 @@ class OpenAIHelper:
             for index, choice in enumerate(response.choices):
                 content = choice.message.content.strip()
                 if index == 0:
-                    self.__add_to_history(chat_id, role="assistant", content=content)
+                    await self.__add_to_history(chat_id, role="assistant", content=content)
                 answer += f'{index + 1}\u20e3\n'
                 answer += content
                 answer += '\n\n'
         else:
             answer = response.choices[0].message.content.strip()
-            self.__add_to_history(chat_id, role="assistant", content=answer)
+            await self.__add_to_history(chat_id, role="assistant", content=answer)
+        self.__schedule_background_summarisation(chat_id)
 
         bot_language = self.config['bot_language']
         # Plugins are not enabled either
@@ -600,12 +758,13 @@ class OpenAIHelper:
         Interprets a given PNG image file using the Vision model.
         """
         image = encode_image(fileobj)
+        image_metadata = self.__image_metadata(fileobj) if self.config['enable_vision_follow_up_questions'] else None
         prompt = self.config['vision_prompt'] if prompt is None else prompt
 
         content = [{'type':'text', 'text':prompt}, {'type':'image_url', \
                     'image_url': {'url':image, 'detail':self.config['vision_detail'] } }]
 
-        response = await self.__common_get_chat_response_vision(chat_id, content, stream=True)
+        response = await self.__common_get_chat_response_vision(chat_id, content, image_metadata, stream=True)
 
         
 
@@ -615,17 +774,15 @@ class OpenAIHelper:
         #         yield response, '0'
         #         return
 
-        answer = ''
-        async for chunk in response:
-            if len(chunk.choices) == 0:
-                continue
-            delta = chunk.choices[0].delta
-            if delta.content:
-                answer += delta.content
-                yield answer, 'not_finished'
-        answer = answer.strip()
-        self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        buffer = StreamBuffer()
+        usage = None
+        async for usage in self.__read_stream(chat_id, response, buffer):
+            if usage is None:
+                yield buffer, 'not_finished'
+        answer = str(buffer).rstrip()
+        await self.__add_to_history(chat_id, role="assistant", content=answer)
+        tokens_used = self.__stream_tokens_used(chat_id, response, usage)
+        self.__schedule_background_summarisation(chat_id)
 
         #show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         #plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
@@ -636,16 +793,147 @@ class OpenAIHelper:
         # elif show_plugins_used:
         #     answer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
 
-        yield answer, tokens_used
+        yield StreamBuffer(answer), tokens_used
 
-    def reset_chat_history(self, chat_id, content=''):
+    async def reset_chat_history(self, chat_id, content=''):
         """
         Resets the conversation history.
         """
         if content == '':
             content = self.config['assistant_prompt']
-        self.conversations[chat_id] = [{"role": "system", "content": content}]
+        system_message = {"role": "system", "content": content}
+        system_tokens = await self.__count_message_tokens(system_message)
+        self.conversations[chat_id] = [system_message]
+        self.conversations_tokens[chat_id] = [system_tokens]
+        self.conversations_images[chat_id] = {}
         self.conversations_vision[chat_id] = False
+        await self.__save_conversation(chat_id)
+
+    def evict_conversation(self, chat_id):
+        """
+        Removes the conversation of the given chat from memory. It is still kept by a persistent conversation store,
+        and loaded again the next time the chat is accessed.
+        :param chat_id: The chat ID
+        """
+        self.conversations.pop(chat_id, None)
+        self.conversations_vision.pop(chat_id, None)
+        self.last_updated.pop(chat_id, None)
+        self.conversations_tokens.pop(chat_id, None)
+        self.conversations_images.pop(chat_id, None)
+
+    def evict_expired_conversations(self, busy_chat_ids=()) -> int:
+        """
+        Removes the conversations that were not used for longer than the maximum conversation age from memory.
+        :param busy_chat_ids: The chats with a request in progress, whose conversations are kept
+        :return: The number of evicted conversations
+        """
+        max_idle_seconds = self.config['max_conversation_age_minutes'] * 60
+        expired = []
+        for chat_id in self.conversations:
+            if self.conversations.idle_seconds(chat_id) <= max_idle_seconds:
+                break
+            if chat_id not in busy_chat_ids and chat_id not in self.summarisation_tasks:
+                expired.append(chat_id)
+        for chat_id in expired:
+            self.evict_conversation(chat_id)
+        return len(expired)
+
+    def conversation_size(self, chat_id) -> int:
+        """
+        Estimates the number of bytes held in memory by the conversation of the given chat,
+        without marking it as used.
+        :param chat_id: The chat ID
+        :return: The estimated number of bytes
+        """
+        return estimate_size(self.conversations.peek(chat_id)) \
+            + estimate_size(self.conversations_tokens.get(chat_id, [])) \
+            + estimate_size(self.conversations_images.get(chat_id, {}))
+
+    def get_memory_stats(self) -> dict[str: tuple[int, int]]:
+        """
+        Returns the number of entries and the estimated number of bytes of each per-chat map held in memory.
+        """
+        maps = {
+            'conversations': self.conversations,
+            'conversations_vision': self.conversations_vision,
+            'last_updated': self.last_updated,
+            'conversations_tokens': self.conversations_tokens,
+            'conversations_images': self.conversations_images,
+        }
+        return {name: (len(values), estimate_size(list(values.values()))) for name, values in maps.items()}
+
+    async def get_plugin_spec_tokens(self) -> dict[str: int]:
+        """
+        Returns the estimated number of tokens that the function specs of each plugin add to every prompt,
+        by the source name of the plugin.
+        """
+        specs_json = self.plugin_manager.get_specs_json()
+        tokens = await self.tokenizer.count_batch(list(specs_json.values()), self.config['model'])
+        return dict(zip(specs_json, tokens))
+
+    async def __load_conversation(self, chat_id):
+        """
+        Loads the conversation of the given chat from the conversation store, unless it is already in memory
+        and no other instance of the bot changed it since.
+        :param chat_id: The chat ID
+        """
+        stale = False
+        if chat_id in self.conversations:
+            stale = await self.store.is_stale(chat_id)
+            if not stale:
+                return
+        conversation = await self.store.load(chat_id)
+        if conversation is None or (not stale and chat_id in self.conversations):
+            return
+        if stale:
+            logging.info(f'The conversation of chat {chat_id} was changed by another instance, loading it again')
+        self.conversations[chat_id] = conversation['messages']
+        self.conversations_tokens[chat_id] = conversation['tokens']
+        self.conversations_images[chat_id] = {}
+        self.conversations_vision[chat_id] = conversation['is_vision']
+        if conversation['last_updated'] is not None:
+            self.last_updated[chat_id] = conversation['last_updated']
+
+    async def __save_conversation(self, chat_id):
+        """
+        Writes the whole conversation of the given chat to the conversation store.
+        :param chat_id: The chat ID
+        """
+        await self.store.save(chat_id, {
+            'messages': list(self.conversations[chat_id]),
+            'tokens': list(self.conversations_tokens[chat_id]),
+            'is_vision': self.conversations_vision[chat_id],
+            'last_updated': self.last_updated.get(chat_id),
+        })
+
+    async def __touch(self, chat_id):
+        """
+        Marks the conversation of the given chat as updated now.
+        :param chat_id: The chat ID
+        """
+        self.last_updated[chat_id] = datetime.datetime.now()
+        await self.store.touch(chat_id, self.conversations_vision[chat_id], self.last_updated[chat_id])
+
+    def __image_metadata(self, fileobj) -> dict:
+        """
+        Computes the metadata of an image once, so that its base64 payload never has to be decoded again.
+        :param fileobj: The image file
+        :return: The width, height and token cost of the image
+        """
+        fileobj.seek(0)
+        width, height = Image.open(fileobj).size
+        return {'width': width, 'height': height, 'tokens': self.__count_tokens_vision(width, height)}
+
+    @staticmethod
+    def __image_urls(content) -> list[str]:
+        """
+        Returns the URLs of the images in the given message content.
+        :param content: The message content
+        :return: The image URLs
+        """
+        if not isinstance(content, list):
+            return []
+        return [part['image_url']['url'] for part in content if part['type'] == 'image_url']
 
     def __max_age_reached(self, chat_id) -> bool:
         """
@@ -660,22 +948,185 @@ class OpenAIHelper:
         max_age_minutes = self.config['max_conversation_age_minutes']
         return last_updated < now - datetime.timedelta(minutes=max_age_minutes)
 
-    def __add_function_call_to_history(self, chat_id, function_name, content):
-        """
-        Adds a function call to the conversation history
-        """
-        self.conversations[chat_id].append({"role": "function", "name": function_name, "content": content})
-
-    def __add_to_history(self, chat_id, role, content):
+    async def __add_to_history(self, chat_id, role, content):
         """
         Adds a message to the conversation history.
         :param chat_id: The chat ID
         :param role: The role of the message sender
         :param content: The message content
         """
-        self.conversations[chat_id].append({"role": role, "content": content})
+        await self.__append_to_history(chat_id, {"role": role, "content": content})
+
+    async def __append_to_history(self, chat_id, message, num_tokens=None):
+        """
+        Appends a message to the conversation history and records its token count in the ledger,
+        so that the size of the conversation never has to be recomputed from scratch.
+        :param chat_id: The chat ID
+        :param message: The message to append
+        :param num_tokens: The token count of the message, if already known
+        """
+        await self.__append_messages_to_history(chat_id, [message], None if num_tokens is None else [num_tokens])
 
-    def get_last_response(self, chat_id, role):
+    async def __append_messages_to_history(self, chat_id, messages, num_tokens=None):
+        """
+        Appends messages to the conversation history and records their token counts in the ledger.
+        All messages are counted before the first one is appended, so that a request cancelled meanwhile
+        (e.g. by /stop) leaves either all of them in the history or none.
+        :param chat_id: The chat ID
+        :param messages: The messages to append
+        :param num_tokens: The token count of each message, if already known
+        """
+        if num_tokens is None:
+            images = self.conversations_images[chat_id]
+            num_tokens = [await self.__count_message_tokens(message, images) for message in messages]
+        ledger = self.conversations_tokens[chat_id]
+        conversation = self.conversations[chat_id]
+        for message, tokens in zip(messages, num_tokens):
+            ledger.append((ledger[-1] if ledger else 0) + tokens)
+            conversation.append(message)
+        # Store the messages even if the request is cancelled, to keep the store in line with the memory
+        await asyncio.shield(self.__store_messages(chat_id, messages, ledger[len(ledger) - len(messages):]))
+
+    async def __store_messages(self, chat_id, messages, cumulative_tokens):
+        """
+        Appends messages and their cumulative token counts to the conversation store, in order.
+        """
+        for message, tokens in zip(messages, cumulative_tokens):
+            await self.store.append(chat_id, message, tokens)
+
+    async def __truncate_history(self, chat_id, max_size):
+        """
+        Keeps only the last `max_size` messages of the conversation history, updating the token ledger.
+        :param chat_id: The chat ID
+        :param max_size: The number of messages to keep
+        """
+        ledger = self.conversations_tokens[chat_id]
+        if len(ledger) <= max_size:
+            return
+        max_size = len(ledger) - self.__skip_tool_results(self.conversations[chat_id], len(ledger) - max_size)
+        offset = ledger[-max_size - 1]
+        self.conversations[chat_id] = self.conversations[chat_id][-max_size:]
+        self.conversations_tokens[chat_id] = [tokens - offset for tokens in ledger[-max_size:]]
+        self.__prune_images(chat_id)
+        await self.__save_conversation(chat_id)
+
+    async def __trim_history_window(self, chat_id):
+        """
+        Keeps the system prompt plus the newest messages that fit within the model's context window
+        (leaving room for the reply) and the maximum history size. The cut-off point is found with
+        a binary search over the cumulative token ledger.
+        :param chat_id: The chat ID
+        """
+        ledger = self.conversations_tokens[chat_id]
+        budget = self.__max_model_tokens() - self.config['max_tokens'] - 3  # every reply is primed with 3 tokens
+        # Messages [start:] fit if ledger[0] + ledger[-1] - ledger[start - 1] <= budget
+        start = bisect.bisect_left(ledger, ledger[0] + ledger[-1] - budget) + 1
+        start = max(start, len(ledger) - self.config['max_history_size'] + 1, 1)
+        start = min(start, len(ledger) - 1)  # always keep the latest message
+        start = self.__skip_tool_results(self.conversations[chat_id], start)
+        if start == 1:
+            return
+
+        logging.info(f'Chat history for chat ID {chat_id} is too long. Dropping the {start - 1} oldest messages...')
+        conversation = self.conversations[chat_id]
+        offset = ledger[start - 1] - ledger[0]
+        self.conversations[chat_id] = [conversation[0]] + conversation[start:]
+        self.conversations_tokens[chat_id] = [ledger[0]] + [tokens - offset for tokens in ledger[start:]]
+        self.__prune_images(chat_id)
+        await self.__save_conversation(chat_id)
+
+    @staticmethod
+    def __skip_tool_results(conversation: list, start: int) -> int:
+        """
+        Moves the start of the kept messages past the results of tool calls whose assistant message is dropped,
+        as the API rejects them without it.
+        :param conversation: The conversation history
+        :param start: The index of the first message to keep
+        :return: The index of the first message to keep that isn't a tool result, or the index of the last message
+        """
+        while start < len(conversation) - 1 and conversation[start]['role'] == 'tool':
+            start += 1
+        return start
+
+    def __prune_images(self, chat_id):
+        """
+        Drops the metadata of images that are no longer part of the conversation history.
+        :param chat_id: The chat ID
+        """
+        images = self.conversations_images[chat_id]
+        if images:
+            kept_urls = {url for message in self.conversations[chat_id]
+                         for url in self.__image_urls(message['content'])}
+            self.conversations_images[chat_id] = {url: images[url] for url in kept_urls if url in images}
+
+    def __history_exceeds_limit(self, chat_id, ratio: float = 1.0) -> bool:
+        """
+        Checks if the conversation history exceeds the given fraction of the token or history size limits.
+        :param chat_id: The chat ID
+        :param ratio: The fraction of the limits to check against
+        :return: A boolean indicating whether the history exceeds the limits
+        """
+        token_count = self.__conversation_tokens(chat_id)
+        exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens() * ratio
+        exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size'] * ratio
+        return exceeded_max_tokens or exceeded_max_history_size
+
+    def __schedule_background_summarisation(self, chat_id):
+        """
+        Starts summarising the conversation history in the background once it crosses the soft limit,
+        so that the next request doesn't have to wait for the summary.
+        :param chat_id: The chat ID
+        """
+        if self.config['history_strategy'] != 'summarise' or not self.config['background_summarisation'] \
+                or chat_id in self.summarisation_tasks:
+            return
+        if not self.__history_exceeds_limit(chat_id, self.config['summarisation_soft_limit']):
+            return
+        conversation = self.conversations[chat_id]
+        task = asyncio.create_task(self.__summarise_in_background(chat_id, conversation, len(conversation)))
+        self.summarisation_tasks[chat_id] = task
+        task.add_done_callback(lambda _: self.summarisation_tasks.pop(chat_id, None))
+
+    async def __summarise_in_background(self, chat_id, conversation: list, summarised_size: int):
+        """
+        Summarises the first messages of the conversation history and swaps the summary in, keeping any messages
+        that were added in the meantime. The summary is discarded if the history was reset or replaced.
+        :param chat_id: The chat ID
+        :param conversation: The conversation history to summarise
+        :param summarised_size: The number of messages to summarise
+        """
+        logging.info(f'Chat history for chat ID {chat_id} is getting long. Summarising in the background...')
+        try:
+            summary = await self.__summarise(conversation[:summarised_size])
+            summary_message = {"role": "assistant", "content": summary}
+            summary_tokens = await self.__count_message_tokens(summary_message)
+        except Exception as e:
+            logging.warning(f'Error while summarising chat history in the background: {str(e)}')
+            return
+
+        if self.conversations.get(chat_id) is not conversation:
+            logging.info(f'Chat history for chat ID {chat_id} changed while summarising, discarding summary')
+            return
+
+        logging.debug(f'Summary: {summary}')
+        ledger = self.conversations_tokens[chat_id]
+        system_tokens = ledger[0]
+        offset = system_tokens + summary_tokens - ledger[summarised_size - 1]
+        self.conversations[chat_id] = [conversation[0], summary_message] + conversation[summarised_size:]
+        self.conversations_tokens[chat_id] = [system_tokens, system_tokens + summary_tokens] + \
+                                             [tokens + offset for tokens in ledger[summarised_size:]]
+        self.__prune_images(chat_id)
+        await self.__save_conversation(chat_id)
+
+    def __conversation_tokens(self, chat_id) -> int:
+        """
+        Returns the number of tokens required to send the conversation history, using the token ledger.
+        :param chat_id: The chat ID
+        :return: the number of tokens required
+        """
+        return self.conversations_tokens[chat_id][-1] + 3  # every reply is primed with <|start|>assistant<|message|>
+
+    async def get_last_response(self, chat_id, role):
         """
         Get the last response from a conversation.
 
@@ -689,6 +1140,7 @@ class OpenAIHelper:
         role matches the last message. None if the conversation doesn't exist or the role doesn't match.
 
         """
+        await self.__load_conversation(chat_id)
         if chat_id not in self.conversations:
             return None
         last_message = self.conversations[chat_id][-1]
@@ -733,18 +1185,14 @@ class OpenAIHelper:
         )
 
     # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    def __count_tokens(self, messages) -> int:
+    async def __count_message_tokens(self, message, images: dict = None) -> int:
         """
-        Counts the number of tokens required to send the given messages.
-        :param messages: the messages to send
-        :return: the number of tokens required
+        Counts the number of tokens of a single message, excluding the reply priming tokens.
+        :param message: the message
+        :param images: the metadata of known images by URL, used to avoid decoding their base64 payload
+        :return: the number of tokens of the message
         """
         model = self.config['model']
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("cl100k_base")
-
         if model in GPT_3_MODELS + GPT_3_16K_MODELS:
             tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
             tokens_per_name = -1  # if there's a name, the role is omitted
@@ -753,42 +1201,44 @@ class OpenAIHelper:
             tokens_per_name = 1
         else:
             raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}.""")
-        num_tokens = 0
-        for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                if key == 'content':
-                    if isinstance(value, str):
-                        num_tokens += len(encoding.encode(value))
-                    else:
-                        for message1 in value:
-                            if message1['type'] == 'image_url':
-                                image = decode_image(message1['image_url']['url'])
-                                num_tokens += self.__count_tokens_vision(image)
+        num_tokens = tokens_per_message
+        texts = []
+        for key, value in message.items():
+            if key == 'content':
+                if isinstance(value, str):
+                    texts.append(value)
+                elif value is not None:
+                    for message1 in value:
+                        if message1['type'] == 'image_url':
+                            image_url = message1['image_url']['url']
+                            if images and image_url in images:
+                                num_tokens += images[image_url]['tokens']
                             else:
-                                num_tokens += len(encoding.encode(message1['text']))
-                else:
-                    num_tokens += len(encoding.encode(value))
-                    if key == "name":
-                        num_tokens += tokens_per_name
-        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+                                width, height = Image.open(io.BytesIO(decode_image(image_url))).size
+                                num_tokens += self.__count_tokens_vision(width, height)
+                        else:
+                            texts.append(message1['text'])
+            elif key == 'tool_calls':
+                texts.extend(tool_call['function'][name] for tool_call in value for name in ('name', 'arguments'))
+            elif value is not None:
+                texts.append(value)
+                if key == "name":
+                    num_tokens += tokens_per_name
+        num_tokens += sum(await self.tokenizer.count_batch(texts, model))
         return num_tokens
 
-    # no longer needed
-
-    def __count_tokens_vision(self, image_bytes: bytes) -> int:
+    def __count_tokens_vision(self, width: int, height: int) -> int:
         """
         Counts the number of tokens for interpreting an image.
-        :param image_bytes: image to interpret
+        :param width: the width of the image to interpret
+        :param height: the height of the image to interpret
         :return: the number of tokens required
         """
-        image_file = io.BytesIO(image_bytes)
-        image = Image.open(image_file)
         model = self.config['vision_model']
         if model not in GPT_4_VISION_MODELS:
             raise NotImplementedError(f"""count_tokens_vision() is not implemented for model {model}.""")
-        
-        w, h = image.size
+
+        w, h = width, height
         if w > h: w, h = h, w
         # this computation follows https://platform.openai.com/docs/guides/vision and https://openai.com/pricing#gpt-4-turbo
         base_tokens = 85
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import json
+import logging
+import time
+
+from lru_dict import LRUDict
+
+
+class PluginCache:
+    """
+    A cache of function results, keyed by the function name and its canonicalized JSON arguments,
+    so that the same lookup isn't repeated while its result is still fresh. Each plugin declares
+    how long its results stay fresh, and the least recently used results are evicted once the cache is full.
+    """
+
+    def __init__(self, max_size: int = 1000):
+        """
+        Initializes the plugin cache.
+        :param max_size: The maximum number of cached results
+        """
+        self.max_size = max_size
+        self.entries = LRUDict()  # {key: (expiry_timestamp, result)}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(function_name: str, arguments: str) -> str | None:
+        """
+        Computes the cache key of a function call, ignoring the order of the arguments and their formatting.
+        :return: The cache key, or None if the arguments aren't valid JSON
+        """
+        try:
+            arguments = json.loads(arguments)
+        except ValueError:
+            return None
+        return function_name + json.dumps(arguments, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+    def get(self, key: str) -> str | None:
+        """
+        Returns the cached result for the given key, or None if there is none or it expired.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        logging.debug(f'Plugin cache hit ({self.hits} hits, {self.misses} misses)')
+        return entry[1]
+
+    def put(self, key: str, result: str, ttl_seconds: float):
+        """
+        Caches the given result, evicting the least recently used entry if the cache is full.
+        """
+        self.entries[key] = (time.monotonic() + ttl_seconds, result)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PluginBusyError(Exception):
+    """
+    Raised when a plugin already has as many pending calls as it accepts
+    """
+    pass
+
+
+class PluginExecutor:
+    """
+    Runs the calls of a plugin that uses blocking libraries in a thread pool of its own, so that they
+    don't block the event loop, nor take up the threads of the other plugins. The number of pending calls
+    is bounded, and callers stop waiting for a call after a timeout.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_pending_calls: int, timeout: float):
+        """
+        Initializes the executor.
+        :param name: The name of the plugin, used to name the threads
+        :param max_workers: The maximum number of calls running at the same time
+        :param max_pending_calls: The maximum number of calls running or waiting for a thread
+        :param timeout: The number of seconds to wait for a call to finish
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'plugin-{name}')
+        self.max_pending_calls = max_pending_calls
+        self.timeout = timeout
+        self.pending_calls = 0
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Runs the given coroutine function to completion in a thread of the pool, with its own event loop.
+        :param function: The coroutine function to run, it must not await anything bound to the bot's event loop
+        :return: The result of the function
+        :raises PluginBusyError: If the plugin has too many pending calls
+        :raises asyncio.TimeoutError: If the call didn't finish in time, it keeps its thread until it does
+        """
+        if self.pending_calls >= self.max_pending_calls:
+            raise PluginBusyError(f'{self.pending_calls} calls are pending')
+
+        loop = asyncio.get_running_loop()
+        self.pending_calls += 1
+        future = self.executor.submit(lambda: asyncio.run(function(*args, **kwargs)))
+        # A call that timed out is still pending until its thread is done with it
+        future.add_done_callback(lambda _: self.__call_done(loop))
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            future.cancel()
+            raise
+
+    def shutdown(self):
+        """
+        Drops the waiting calls, without waiting for the running ones
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __call_done(self, loop: asyncio.AbstractEventLoop):
+        try:
+            loop.call_soon_threadsafe(self.__decrement_pending_calls)
+        except RuntimeError:
+            pass  # The event loop was closed while the call was running
+
+    def __decrement_pending_calls(self):
+        self.pending_calls -= 1
@@ -1,5 +1,11 @@
+import asyncio
+import datetime
 import json
-from pprint import pprint
+import logging
+
+from http_client import create_http_client
+from plugin_cache import PluginCache
+from plugin_executor import PluginExecutor, PluginBusyError
 
 from plugins.wiki_bot import WikipediaPlugin
 from plugins.gtts_text_to_speech import GTTSTextToSpeech
@@ -49,30 +55,81 @@ class PluginManager:
             'webshot': WebshotPlugin,
         }
         self.plugins = [plugin_mapping[plugin]() for plugin in enabled_plugins if plugin in plugin_mapping]
+        self.http_client = create_http_client()
+        for plugin in self.plugins:
+            plugin.http_client = self.http_client
+        self.executors = {plugin: PluginExecutor(plugin.get_source_name(), plugin.max_workers,
+                                                 plugin.max_pending_calls, plugin.execution_timeout)
+                          for plugin in self.plugins if plugin.blocking}
+        self.cache = PluginCache(max_size=config.get('plugin_cache_max_size', 1000))
+        self.registry_date = None
+        self.__compile_registry()
 
-    def get_functions_specs_tools(self):
+    async def close(self):
         """
-        Return the list of function specs that can be called by the model
+        Closes the HTTP client shared by the plugins and the thread pools of the blocking plugins
         """
-        f_list = [spec for specs in map(lambda plugin: plugin.get_spec(), self.plugins) for spec in specs]
-        f_dict = [{"type": "function", "function": f} for f in f_list]
-        return f_dict
+        await self.http_client.aclose()
+        for executor in self.executors.values():
+            executor.shutdown()
 
-    def get_functions_specs_functions(self):
+    def get_functions_specs_tools(self) -> tuple:
         """
         Return the list of function specs that can be called by the model
         """
-        f_list = [spec for specs in map(lambda plugin: plugin.get_spec(), self.plugins) for spec in specs]
-        return f_list
+        return self.__registry()['specs_tools']
+
+    def get_specs_json(self) -> dict[str, str]:
+        """
+        Return the tool specs of each plugin serialized as JSON, by the source name of the plugin
+        """
+        return self.__registry()['specs_json']
 
     async def call_function(self, function_name, helper, arguments):
         """
-        Call a function based on the name and parameters provided
+        Call a function based on the name and parameters provided, serving it from the cache
+        if the plugin caches its results and the same call was made recently
         """
         plugin = self.__get_plugin_by_function_name(function_name)
         if not plugin:
             return json.dumps({'error': f'Function {function_name} not found'})
-        return json.dumps(await plugin.execute(function_name, helper, **json.loads(arguments)), default=str)
+        key = PluginCache.key(function_name, arguments) if plugin.cache_ttl_seconds > 0 else None
+        if key is not None:
+            response = self.cache.get(key)
+            if response is not None:
+                logging.info(f'Serving function {function_name} from the plugin cache')
+                return response
+
+        result = await self.__execute(plugin, function_name, helper, arguments)
+        response = json.dumps(result, default=str)
+        if key is not None and self.__is_cacheable(result):
+            self.cache.put(key, response, plugin.cache_ttl_seconds)
+        return response
+
+    async def __execute(self, plugin, function_name, helper, arguments):
+        """
+        Executes a function of the plugin, in the plugin's thread pool if it is blocking
+        """
+        executor = self.executors.get(plugin)
+        if executor is None:
+            return await plugin.execute(function_name, helper, **json.loads(arguments))
+
+        try:
+            return await executor.run(plugin.execute, function_name, helper, **json.loads(arguments))
+        except PluginBusyError as e:
+            logging.warning(f'Function {function_name} is busy: {str(e)}')
+            return {'error': f'Function {function_name} is busy, try again later'}
+        except asyncio.TimeoutError:
+            logging.warning(f'Function {function_name} timed out after {executor.timeout} seconds')
+            return {'error': f'Function {function_name} timed out'}
+
+    @staticmethod
+    def __is_cacheable(result) -> bool:
+        """
+        Whether a function result may be cached: errors are retried, and direct results refer to files
+        that are deleted once they are sent
+        """
+        return not isinstance(result, dict) or ('error' not in result and 'direct_result' not in result)
 
     def get_plugin_source_name(self, function_name) -> str:
         """
@@ -84,5 +141,31 @@ class PluginManager:
         return plugin.get_source_name()
 
     def __get_plugin_by_function_name(self, function_name):
-        return next((plugin for plugin in self.plugins
-                     if function_name in map(lambda spec: spec.get('name'), plugin.get_spec())), None)
+        return self.__registry()['functions'].get(function_name)
+
+    def __registry(self) -> dict:
+        """
+        Return the compiled registry, compiling it again once the date changed, as some specs mention it
+        """
+        if self.registry_date != datetime.date.today():
+            self.__compile_registry()
+        return self.registry
+
+    def __compile_registry(self):
+        """
+        Collects the function specs of all plugins once, instead of on every request and function call
+        """
+        functions, specs_tools, specs_json = {}, [], {}
+        for plugin in self.plugins:
+            specs = plugin.get_spec()
+            tools = [{"type": "function", "function": spec} for spec in specs]
+            for spec in specs:
+                functions.setdefault(spec.get('name'), plugin)
+            specs_tools += tools
+            specs_json[plugin.get_source_name()] = json.dumps(tools)
+        self.registry = {
+            'functions': functions,  # {function_name: plugin}
+            'specs_tools': tuple(specs_tools),
+            'specs_json': specs_json,  # {source_name: json}
+        }
+        self.registry_date = datetime.date.today()
@@ -1,7 +1,5 @@
 from typing import Dict
 
-import requests
-
 from .plugin import Plugin
 
 
@@ -10,6 +8,8 @@ class CryptoPlugin(Plugin):
     """
     A plugin to fetch the current rate of various cryptocurrencies
     """
+    cache_ttl_seconds = 30
+
     def get_source_name(self) -> str:
         return "CoinCap"
 
@@ -27,4 +27,4 @@ class CryptoPlugin(Plugin):
         }]
 
     async def execute(self, function_name, helper, **kwargs) -> Dict:
-        return requests.get(f"https://api.coincap.io/v2/rates/{kwargs['asset']}").json()
+        return (await self.http_client.get(f"https://api.coincap.io/v2/rates/{kwargs['asset']}")).json()
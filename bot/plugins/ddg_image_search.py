@@ -12,6 +12,8 @@ class DDGImageSearchPlugin(Plugin):
     """
     A plugin to search images and GIFs for a given query, using DuckDuckGo
     """
+    blocking = True
+
     def __init__(self):
         self.safesearch = os.getenv('DUCKDUCKGO_SAFESEARCH', 'moderate')
 
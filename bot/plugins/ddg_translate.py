@@ -9,6 +9,8 @@ class DDGTranslatePlugin(Plugin):
     """
     A plugin to translate a given text from a language to another, using DuckDuckGo
     """
+    blocking = True
+
     def get_source_name(self) -> str:
         return "DuckDuckGo Translate"
 
@@ -11,6 +11,8 @@ class DDGWebSearchPlugin(Plugin):
     """
     A plugin to search the web for a given query, using DuckDuckGo
     """
+    blocking = True
+
     def __init__(self):
         self.safesearch = os.getenv('DUCKDUCKGO_SAFESEARCH', 'moderate')
 
@@ -7,6 +7,8 @@ class DicePlugin(Plugin):
     """
     A plugin to send a die in the chat
     """
+    cache_ttl_seconds = 0  # Every roll must be a new one
+
     def get_source_name(self) -> str:
         return "Dice"
 
@@ -2,7 +2,6 @@ import logging
 import pprint
 from typing import Dict
 import os
-import requests
 
 from .plugin import Plugin
 
@@ -101,7 +100,7 @@ class GooglePlacesTextSearchPlugin(Plugin):
             'maxResultCount': result_count,
             'regionCode': self.region_code,
         }
-        response = requests.post(url, headers=headers, json=data)
+        response = await self.http_client.post(url, headers=headers, json=data)
 
         if response.status_code == 200:
             logging.info(pprint.pformat(response.json()))
@@ -10,6 +10,7 @@ class GTTSTextToSpeech(Plugin):
     """
     A plugin to convert text to speech using Google Translate's Text to Speech API
     """
+    blocking = True
 
     def get_source_name(self) -> str:
         return "gTTS"
@@ -1,11 +1,26 @@
 from abc import abstractmethod, ABC
 from typing import Dict
 
+import httpx
+
 
 class Plugin(ABC):
     """
     A plugin interface which can be used to create plugins for the ChatGPT API.
     """
+    # The HTTP client shared by all plugins, set by the PluginManager. Use it instead of blocking HTTP libraries
+    http_client: httpx.AsyncClient = None
+
+    # Set blocking to True if execute calls blocking libraries, the PluginManager then runs it in a thread pool
+    # of the plugin with its own event loop, so it must not await anything bound to the bot's event loop
+    blocking = False
+    max_workers = 4  # The maximum number of calls of a blocking plugin running at the same time
+    max_pending_calls = 16  # The maximum number of calls of a blocking plugin running or waiting for a thread
+    execution_timeout = 30.0  # The number of seconds to wait for a call of a blocking plugin
+
+    # The number of seconds the results of the plugin's functions are cached for, calls with the same
+    # arguments are then served from the cache. 0 disables caching, for results that must be fresh every time
+    cache_ttl_seconds = 0
 
     @abstractmethod
     def get_source_name(self) -> str:
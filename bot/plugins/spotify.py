@@ -11,6 +11,8 @@ class SpotifyPlugin(Plugin):
     """
     A plugin to fetch information from Spotify
     """
+    blocking = True
+
     def __init__(self):
         spotify_client_id = os.getenv('SPOTIFY_CLIENT_ID')
         spotify_client_secret = os.getenv('SPOTIFY_CLIENT_SECRET')
@@ -2,8 +2,6 @@ import logging
 from datetime import datetime
 from typing import Dict
 
-import requests
-
 from .plugin import Plugin
 
 
@@ -11,6 +9,7 @@ class WeatherPlugin(Plugin):
     """
     A plugin to get the current weather and 7-day daily forecast for a location
     """
+    cache_ttl_seconds = 600
 
     def get_source_name(self) -> str:
         return "OpenMeteo"
@@ -65,7 +64,7 @@ class WeatherPlugin(Plugin):
               f'&temperature_unit={kwargs["unit"]}'
         if function_name == 'get_current_weather':
             url += '&current_weather=true'
-            result = requests.get(url).json()
+            result = (await self.http_client.get(url)).json()
             logging.debug(function_name, result)
             return result
 
@@ -73,7 +72,7 @@ class WeatherPlugin(Plugin):
             url += '&daily=weathercode,temperature_2m_max,temperature_2m_min,precipitation_probability_mean,'
             url += f'&forecast_days={kwargs["forecast_days"]}'
             url += '&timezone=auto'
-            response = requests.get(url).json()
+            response = (await self.http_client.get(url)).json()
             results = {}
             for i, time in enumerate(response["daily"]["time"]):
                 results[datetime.strptime(time, "%Y-%m-%d").strftime("%A, %B %d, %Y")] = {
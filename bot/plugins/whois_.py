@@ -8,6 +8,8 @@ class WhoisPlugin(Plugin):
     """
     A plugin to query whois database
     """
+    blocking = True
+
     def get_source_name(self) -> str:
         return "Whois"
 
@@ -7,6 +7,9 @@ from .plugin import Plugin
 
 
 class WikipediaPlugin(Plugin):
+    blocking = True
+    max_workers = 1  # wikipedia.set_lang changes the language globally
+    cache_ttl_seconds = 86400
 
     def __init__(self):
         self.language_code = os.getenv('WIKIPEDIA_LANGUAGE_CODE', default="en")
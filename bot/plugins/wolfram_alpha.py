@@ -10,6 +10,8 @@ class WolframAlphaPlugin(Plugin):
     """
     A plugin to answer questions using WolframAlpha.
     """
+    blocking = True
+
     def __init__(self):
         wolfram_app_id = os.getenv('WOLFRAM_APP_ID')
         if not wolfram_app_id:
@@ -11,6 +11,9 @@ class YouTubeAudioExtractorPlugin(Plugin):
     """
     A plugin to extract audio from a YouTube video
     """
+    blocking = True
+    max_workers = 2
+    execution_timeout = 300.0  # Downloading the audio can take a while
 
     def get_source_name(self) -> str:
         return "YouTube Audio Extractor"
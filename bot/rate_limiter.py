@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from lru_dict import LRUDict
+
+# Requests with a lower priority value are sent first
+FINAL_EDIT_PRIORITY = 0
+DEFAULT_PRIORITY = 1
+INTERMEDIATE_EDIT_PRIORITY = 2
+CHAT_ACTION_PRIORITY = 3
+
+
+class TokenBucket:
+    """
+    A token bucket that lets waiting requests through in order of priority.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        Initializes a full bucket.
+        :param rate: The number of tokens added per second
+        :param capacity: The maximum number of tokens, i.e. the size of a burst
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.waiters = []  # heap of (priority, sequence, future)
+        self.sequence = itertools.count()
+        self.timer = None
+
+    async def acquire(self, priority: int = DEFAULT_PRIORITY):
+        """
+        Waits until a token is available and takes it.
+        :param priority: The priority of the request, lower values are served first
+        """
+        self.__refill()
+        if not self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        self.__schedule()
+        await future
+
+    def pause(self, seconds: float):
+        """
+        Empties the bucket and stops refilling it for the given number of seconds, e.g. after a flood wait.
+        """
+        self.tokens = 0
+        self.updated = max(self.updated, time.monotonic() + seconds)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.__schedule()
+
+    def is_idle(self) -> bool:
+        """
+        Whether the bucket is full and nobody is waiting for it.
+        """
+        self.__refill()
+        return not self.waiters and self.tokens >= self.capacity
+
+    def __refill(self):
+        now = time.monotonic()
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def __schedule(self):
+        while self.waiters and self.waiters[0][2].done():
+            heapq.heappop(self.waiters)  # cancelled
+        if self.timer is not None or not self.waiters:
+            return
+        delay = max(self.updated - time.monotonic(), 0) + max(1 - self.tokens, 0) / self.rate
+        self.timer = asyncio.get_running_loop().call_later(delay, self.__wake)
+
+    def __wake(self):
+        self.timer = None
+        self.__refill()
+        while self.waiters and self.tokens >= 1:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.tokens -= 1
+                future.set_result(None)
+        self.__schedule()
+
+
+class TelegramRateLimiter(BaseRateLimiter[dict]):
+    """
+    Throttles all outgoing Bot API requests that send or edit messages, so that the bot stays below
+    Telegram's flood limits: about 30 messages per second overall, one per second in a private chat
+    and 20 per minute in a group. Waiting requests are sent in order of priority, which can be set with
+    `rate_limit_args={'priority': ...}`, so that final edits of streamed answers overtake intermediate ones.
+    """
+
+    def __init__(self, overall_rate: float = 30, private_chat_rate: float = 1, group_chat_rate: float = 20 / 60,
+                 max_retries: int = 1):
+        """
+        Initializes the rate limiter.
+        :param overall_rate: The maximum number of requests per second across all chats
+        :param private_chat_rate: The maximum number of requests per second in a private chat
+        :param group_chat_rate: The maximum number of requests per second in a group chat
+        :param max_retries: The number of times a request is retried when Telegram still asks to wait
+        """
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.max_retries = max_retries
+        self.overall_bucket = TokenBucket(overall_rate, overall_rate)
+        self.chat_buckets = LRUDict()  # {chat_id: bucket}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(('send', 'edit', 'copy', 'forward')):
+            return await callback(*args, **kwargs)
+
+        is_chat_action = endpoint == 'sendChatAction'
+        default_priority = CHAT_ACTION_PRIORITY if is_chat_action else DEFAULT_PRIORITY
+        priority = (rate_limit_args or {}).get('priority', default_priority)
+        # Chat actions aren't messages, so they don't count against the limits of a chat
+        chat_id = data.get('chat_id') if not is_chat_action else None
+
+        for attempt in range(self.max_retries + 1):
+            chat_bucket = self.__chat_bucket(chat_id) if chat_id is not None else None
+            if chat_bucket is not None:
+                await chat_bucket.acquire(priority)
+            await self.overall_bucket.acquire(priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                logging.warning(f'Flood control exceeded for {endpoint} in chat {chat_id}, '
+                                f'pausing for {e.retry_after} seconds')
+                (chat_bucket or self.overall_bucket).pause(e.retry_after)
+                if attempt == self.max_retries or priority > DEFAULT_PRIORITY:
+                    # Intermediate edits are outdated by then, let the caller decide what to do
+                    raise
+
+    def __chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Drop the buckets of chats that have been quiet for a while, they are full anyway
+            while len(self.chat_buckets) > 0 and self.chat_buckets.idle_seconds(next(iter(self.chat_buckets))) > 600:
+                key = next(iter(self.chat_buckets))
+                if not self.chat_buckets.peek(key).is_idle():
+                    break
+                self.chat_buckets.pop(key)
+            is_group = not str(chat_id).lstrip('-').isdigit() or int(chat_id) < 0
+            rate = self.group_chat_rate if is_group else self.private_chat_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, max(1.0, rate * 3))
+        return bucket
@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import time
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from lru_dict import LRUDict
+from single_flight import close_stream
+
+
+class CachedStream:
+    """
+    Replays the chunks of a cached chat completion like a streamed response.
+    """
+    reused = True
+
+    def __init__(self, chunks: list[ChatCompletionChunk]):
+        self.chunks = iter(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> ChatCompletionChunk:
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class ResponseCache:
+    """
+    An exact-match cache of chat completions, keyed by a hash of the request arguments.
+    Entries expire after a TTL, and the least recently used entries are evicted once the cache is full.
+    Streamed and non-streamed requests share the same entries, as only the resulting choices are stored.
+    """
+
+    def __init__(self, mode: str = 'auto', ttl_seconds: int = 3600, max_size: int = 1000):
+        """
+        Initializes the response cache.
+        :param mode: `auto` to cache requests with a temperature of 0 only, `always` to cache all requests
+        :param ttl_seconds: The number of seconds after which a cached response expires
+        :param max_size: The maximum number of cached responses
+        """
+        self.mode = mode
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.entries = LRUDict()  # {key: (expiry_timestamp, choices)}
+        self.hits = 0
+        self.misses = 0
+
+    def is_cacheable(self, args: dict) -> bool:
+        """
+        Whether the response to a request with the given arguments may be cached.
+        Requests without a temperature use the API's default temperature of 1.
+        """
+        return self.mode == 'always' or args.get('temperature', 1) == 0
+
+    @staticmethod
+    def key(args: dict) -> str:
+        """
+        Computes the cache key of a request from all of its arguments except the stream flags.
+        """
+        request = {name: value for name, value in args.items() if name not in ('stream', 'stream_options')}
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key: str) -> list[dict] | None:
+        """
+        Returns the cached choices for the given key, or None if there are none or they expired.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        logging.debug(f'Response cache hit ({self.hits} hits, {self.misses} misses)')
+        return entry[1]
+
+    def put(self, key: str, choices: list[dict]):
+        """
+        Caches the given choices, evicting the least recently used entry if the cache is full.
+        """
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, choices)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def put_completion(self, key: str, response: ChatCompletion):
+        """
+        Caches the choices of the given chat completion.
+        """
+        self.put(key, self.choices(response))
+
+    async def record_stream(self, key: str, response):
+        """
+        Passes the chunks of a streamed response through, and caches the assembled choices
+        once the stream is complete.
+        :param key: The cache key of the request
+        :param response: The streamed response
+        """
+        choices = {}
+        try:
+            async for chunk in response:
+                for choice in chunk.choices:
+                    entry = choices.setdefault(choice.index, {
+                        'index': choice.index,
+                        'message': {'role': 'assistant', 'content': None, 'function_call': None, 'tool_calls': None},
+                        'finish_reason': None,
+                    })
+                    self.__merge_delta(entry['message'], choice.delta)
+                    if choice.finish_reason:
+                        entry['finish_reason'] = choice.finish_reason
+                yield chunk
+        finally:
+            # Release the HTTP response if the stream is closed early
+            await close_stream(response)
+
+        if choices and all(choice['finish_reason'] for choice in choices.values()):
+            self.put(key, [choices[index] for index in sorted(choices)])
+
+    @staticmethod
+    def choices(response: ChatCompletion) -> list[dict]:
+        """
+        Returns the choices of the given chat completion as dictionaries.
+        """
+        return [choice.model_dump(include={'index', 'message', 'finish_reason'}) for choice in response.choices]
+
+    @staticmethod
+    def to_completion(choices: list[dict], model: str) -> ChatCompletion:
+        """
+        Builds a chat completion from cached choices. Its usage is zero, as no tokens were spent on it.
+        """
+        return ChatCompletion.model_validate({
+            'id': 'cached',
+            'choices': choices,
+            'created': int(time.time()),
+            'model': model,
+            'object': 'chat.completion',
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        })
+
+    @staticmethod
+    def to_stream(choices: list[dict], model: str) -> CachedStream:
+        """
+        Builds a streamed response from cached choices, starting with a role-only chunk like the API does.
+        """
+        def chunk(index: int, delta: dict, finish_reason: str = None) -> ChatCompletionChunk:
+            return ChatCompletionChunk.model_validate({
+                'id': 'cached',
+                'choices': [{'index': index, 'delta': delta, 'finish_reason': finish_reason}],
+                'created': int(time.time()),
+                'model': model,
+                'object': 'chat.completion.chunk',
+            })
+
+        chunks = []
+        for choice in choices:
+            message = choice['message']
+            chunks.append(chunk(choice['index'], {'role': 'assistant', 'content': ''}))
+            delta = {name: message[name] for name in ('content', 'function_call', 'tool_calls') if message.get(name)}
+            if 'tool_calls' in delta:
+                delta['tool_calls'] = [{'index': index, **tool_call}
+                                       for index, tool_call in enumerate(delta['tool_calls'])]
+            if delta:
+                chunks.append(chunk(choice['index'], delta))
+            chunks.append(chunk(choice['index'], {}, choice['finish_reason']))
+        return CachedStream(chunks)
+
+    @staticmethod
+    def __merge_delta(message: dict, delta):
+        """
+        Appends a streamed delta to the assembled message.
+        """
+        if delta.content:
+            message['content'] = (message['content'] or '') + delta.content
+        if delta.function_call:
+            function_call = message['function_call'] = message['function_call'] or {'name': '', 'arguments': ''}
+            function_call['name'] += delta.function_call.name or ''
+            function_call['arguments'] += delta.function_call.arguments or ''
+        for tool_call in delta.tool_calls or []:
+            tool_calls = message['tool_calls'] = message['tool_calls'] or []
+            while len(tool_calls) <= tool_call.index:
+                tool_calls.append({'id': '', 'type': 'function', 'function': {'name': '', 'arguments': ''}})
+            entry = tool_calls[tool_call.index]
+            entry['id'] += tool_call.id or ''
+            if tool_call.function:
+                entry['function']['name'] += tool_call.function.name or ''
+                entry['function']['arguments'] += tool_call.function.arguments or ''
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import asyncio
+import inspect
+
+
+async def close_stream(stream):
+    """
+    Closes a stream of chunks early, releasing its HTTP response so that OpenAI stops generating.
+    Streams without a close method, e.g. cached ones, are left as they are.
+    """
+    close = getattr(stream, 'aclose', None) or getattr(stream, 'close', None)
+    if close is not None:
+        result = close()
+        if inspect.isawaitable(result):
+            await result
+
+
+class SharedStream:
+    """
+    Consumes an upstream stream once, in the background, and replays its chunks to any number of subscribers.
+    Subscribers that join late first receive the chunks they missed.
+    Once all subscribers closed their subscription, the upstream stream is closed.
+    """
+
+    def __init__(self, upstream, on_stop=None):
+        """
+        Starts consuming the upstream stream.
+        :param upstream: The stream to share
+        :param on_stop: A function called when the stream is stopped because all subscribers left
+        """
+        self.on_stop = on_stop
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        self.subscribers = 0
+        self.updated = asyncio.Event()
+        self.task = asyncio.create_task(self.__pump(upstream))
+
+    def subscribe(self, reused: bool) -> StreamSubscriber:
+        """
+        Returns a new subscriber receiving all the chunks of the stream.
+        :param reused: Whether the subscriber shares a stream requested by someone else
+        """
+        self.subscribers += 1
+        return StreamSubscriber(self, reused)
+
+    def unsubscribe(self):
+        """
+        Ends a subscription, stopping the stream if it was the last one.
+        """
+        self.subscribers -= 1
+        if self.subscribers <= 0 and not self.finished:
+            self.task.cancel()
+            if self.on_stop is not None:
+                self.on_stop()
+
+    async def wait(self):
+        """
+        Waits until a new chunk arrives or the stream ends.
+        """
+        await self.updated.wait()
+
+    async def __pump(self, upstream):
+        try:
+            async for chunk in upstream:
+                self.chunks.append(chunk)
+                self.__notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+            await close_stream(upstream)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self.__notify()
+
+    def __notify(self):
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+
+class StreamSubscriber:
+    """
+    Iterates over the chunks of a shared stream.
+    """
+
+    def __init__(self, stream: SharedStream, reused: bool):
+        self.stream = stream
+        self.reused = reused
+        self.index = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while self.index >= len(self.stream.chunks):
+            if self.stream.finished:
+                if self.stream.error is not None:
+                    raise self.stream.error
+                raise StopAsyncIteration
+            await self.stream.wait()
+        chunk = self.stream.chunks[self.index]
+        self.index += 1
+        return chunk
+
+    async def close(self):
+        """
+        Stops receiving chunks, closing the upstream stream if nobody else receives them.
+        """
+        if not self.closed:
+            self.closed = True
+            self.stream.unsubscribe()
+
+
+class SingleFlight:
+    """
+    Deduplicates identical concurrent requests: while a request is in flight, identical requests
+    wait for its result (or subscribe to its stream) instead of being sent again.
+    """
+
+    def __init__(self):
+        self.calls: dict[str: asyncio.Task] = {}  # {key: task}
+        self.streams: dict[str: asyncio.Task] = {}  # {key: task opening the shared stream}
+
+    async def call(self, key: str, request) -> tuple[any, bool]:
+        """
+        Runs the given request, unless an identical one is already in flight.
+        :param key: The key identifying the request
+        :param request: A coroutine function sending the request
+        :return: The result, and whether it was shared with an identical request
+        """
+        task = self.calls.get(key)
+        if task is not None:
+            return await asyncio.shield(task), True
+
+        task = self.calls[key] = asyncio.ensure_future(request())
+        task.add_done_callback(lambda _: self.__forget(self.calls, key, task))
+        return await asyncio.shield(task), False
+
+    async def stream(self, key: str, request) -> StreamSubscriber:
+        """
+        Opens the given streamed request, unless an identical one is still streaming,
+        and subscribes to its chunks.
+        :param key: The key identifying the request
+        :param request: A coroutine function opening the stream
+        :return: A subscriber iterating over the chunks of the stream
+        """
+        task = self.streams.get(key)
+        reused = task is not None
+        if not reused:
+            task = self.streams[key] = asyncio.ensure_future(self.__open_stream(key, request))
+        shared_stream = await asyncio.shield(task)
+        return shared_stream.subscribe(reused)
+
+    async def __open_stream(self, key: str, request) -> SharedStream:
+        task = asyncio.current_task()
+        try:
+            shared_stream = SharedStream(await request(), on_stop=lambda: self.__forget(self.streams, key, task))
+        except BaseException:
+            self.__forget(self.streams, key, task)
+            raise
+        shared_stream.task.add_done_callback(lambda _: self.__forget(self.streams, key, task))
+        return shared_stream
+
+    @staticmethod
+    def __forget(tasks: dict, key: str, task: asyncio.Task):
+        if tasks.get(key) is task:
+            del tasks[key]
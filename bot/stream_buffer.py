@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import bisect
+
+
+class StreamBuffer:
+    """
+    Accumulates a streamed answer as a list of deltas, so that appending a delta never copies the whole answer.
+    Slicing only joins the deltas that the slice spans, so reading the tail of a long answer
+    costs as much as the tail itself. Leading whitespace of the answer is dropped.
+    """
+
+    def __init__(self, text: str = ''):
+        self.parts: list[str] = []
+        self.offsets: list[int] = []  # the offset of each part in the answer
+        self.length = 0
+        self.delta = ''  # the last appended delta
+        self.append(text)
+
+    def append(self, delta: str):
+        """
+        Appends a delta to the answer.
+        """
+        if self.length == 0:
+            delta = delta.lstrip()
+        if not delta:
+            return
+        self.parts.append(delta)
+        self.offsets.append(self.length)
+        self.length += len(delta)
+        self.delta = delta
+
+    def slice(self, start: int, end: int | None = None) -> str:
+        """
+        Returns the characters of the answer between the given offsets.
+        :param start: The offset of the first character
+        :param end: The offset after the last character, or None for the end of the answer
+        """
+        end = self.length if end is None else min(end, self.length)
+        if start >= end:
+            return ''
+        first = bisect.bisect_right(self.offsets, start) - 1
+        last = bisect.bisect_left(self.offsets, end)
+        text = ''.join(self.parts[first:last])
+        head = start - self.offsets[first]
+        if last == len(self.parts) and last - first > 1:
+            # Merge the joined tail from the start of the slice on, so that reading it again
+            # only joins the deltas appended since, without dragging along the text before it
+            self.parts[first:] = [text[:head], text[head:]] if head else [text]
+            self.offsets[first + 1:] = [start] if head else []
+        return text[head:end - start + head]
+
+    def __getitem__(self, key: slice) -> str:
+        start, end, _ = key.indices(self.length)
+        return self.slice(start, end)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __str__(self) -> str:
+        text = ''.join(self.parts)
+        if len(self.parts) > 1:
+            # Join the parts only once
+            self.parts, self.offsets = [text], [0]
+        return text
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+from telegram import Update
+from telegram.error import RetryAfter, TimedOut
+from telegram.ext import CallbackContext
+
+from message_splitter import MessageSplitter
+from rate_limiter import FINAL_EDIT_PRIORITY, INTERMEDIATE_EDIT_PRIORITY
+from stream_buffer import StreamBuffer
+from telegram_markdown import close_markdown
+from utils import edit_message_with_retry, get_reply_to_message_id, get_thread_id, is_group_chat, is_direct_result, \
+    reply_text_with_fallback, get_message_states, get_parse_mode
+
+
+class StreamRenderer:
+    """
+    Renders a streamed answer into Telegram messages.
+    The message is edited at most once per interval, which depends on the chat type (group chats have stricter
+    flood limits) and grows whenever Telegram asks to retry later. Answers longer than Telegram's message limit
+    continue in a new message, except for inline messages, which only show the beginning of the answer.
+    Partial answers are shown with markdown too, by closing the entity they leave open.
+    The stream is consumed by its own task, so that slow edits never hold back reading the answer from OpenAI.
+    """
+    private_chat_interval = 1.0
+    group_chat_interval = 3.0
+    inline_interval = 1.5
+    max_interval = 30.0
+    max_message_length = 4096
+    max_final_attempts = 3
+
+    def __init__(self, update: Update, context: CallbackContext, config: dict, inline_message_id: str = None,
+                 header: str = '', markdown_header: str = None):
+        """
+        Initializes the renderer.
+        :param update: The update to answer
+        :param context: The context to use
+        :param config: A dictionary containing the bot configuration
+        :param inline_message_id: The inline message to edit, if answering an inline query
+        :param header: The text to show before the answer
+        :param markdown_header: The text to show before the answer when it is formatted with markdown
+        """
+        self.update = update
+        self.context = context
+        self.config = config
+        self.inline_message_id = inline_message_id
+        self.header = header
+        self.markdown_header = header if markdown_header is None else markdown_header
+        if inline_message_id is not None:
+            self.base_interval = self.inline_interval
+        elif is_group_chat(update):
+            self.base_interval = self.group_chat_interval
+        else:
+            self.base_interval = self.private_chat_interval
+        self.interval = self.base_interval
+        self.next_edit_at = 0.0
+        self.message = None  # the message currently being edited
+        self.splitter = MessageSplitter(self.max_message_length)
+        self.chunk_index = 0  # the index of the current message among the messages of the answer
+        self.rendered = ''  # the text of the current message
+        self.latest = None  # the newest (content, tokens) tuple of the stream
+        self.updated = asyncio.Event()
+
+    async def consume(self, stream) -> tuple[any, str]:
+        """
+        Reads the given stream in a separate task and shows the newest answer whenever the edit interval elapses,
+        skipping the intermediate states that arrived in the meantime.
+        :param stream: The stream of (content, tokens) tuples, as returned by OpenAIHelper.get_chat_response_stream
+        :return: The last (content, tokens) tuple of the stream, which may be a direct result
+        """
+        producer = asyncio.create_task(self.__produce(stream))
+        try:
+            while not producer.done():
+                delay = self.next_edit_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.wait({producer}, timeout=delay)
+                    continue
+                self.updated.clear()
+                content, tokens = self.latest or (None, None)
+                if tokens == 'not_finished':
+                    await self.render(content)
+                waiter = asyncio.ensure_future(self.updated.wait())
+                await asyncio.wait({producer, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+            content, tokens = await producer
+        finally:
+            if not producer.done():
+                # Stopped, let the stream close itself and keep the partial answer before returning
+                producer.cancel()
+                await asyncio.wait({producer})
+
+        if content is not None and not is_direct_result(content):
+            await self.render(content, finished=True)
+        return content, tokens
+
+    async def __produce(self, stream) -> tuple[any, str]:
+        """
+        Stores every item of the stream in the latest-value slot.
+        """
+        async for content, tokens in stream:
+            self.latest = (content, tokens)
+            self.updated.set()
+        return self.latest or (None, None)
+
+    async def render(self, content: StreamBuffer, finished: bool = False):
+        """
+        Shows the answer streamed so far, if the edit interval has elapsed or the answer is finished.
+        :param content: The answer streamed so far
+        :param finished: Whether the answer is complete, in which case it is always shown, formatted with markdown
+        """
+        if len(content) == 0:
+            return
+
+        if self.inline_message_id is None:
+            await self.__roll_over(content)
+            text = plain_text = self.splitter.current(content)
+        else:
+            answer = content.slice(0, self.max_message_length)
+            text = (self.markdown_header + answer)[:self.max_message_length]
+            plain_text = (self.header + answer)[:self.max_message_length]
+
+        if not finished:
+            # Close the entity the partial answer leaves open, so that it can be shown with markdown already
+            closed_text = close_markdown(text, self.max_message_length)
+            markdown = closed_text is not None
+            text = closed_text if markdown else plain_text
+            if time.monotonic() >= self.next_edit_at and text != self.rendered:
+                await self.__publish(text, markdown=markdown, priority=INTERMEDIATE_EDIT_PRIORITY)
+            return
+
+        for _ in range(self.max_final_attempts):
+            delay = self.next_edit_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if await self.__publish(text, markdown=True, priority=FINAL_EDIT_PRIORITY):
+                return
+
+    async def __roll_over(self, content: StreamBuffer):
+        """
+        Completes the current message and moves on to a new one while the answer doesn't fit.
+        The splitter ends each message at a paragraph or line boundary and keeps code blocks balanced.
+        """
+        for chunk in self.splitter.split(content):
+            if self.message is not None:
+                try:
+                    await edit_message_with_retry(self.context, self.message.chat_id, str(self.message.message_id),
+                                                  chunk, rate_limit_args={'priority': FINAL_EDIT_PRIORITY})
+                except Exception as e:
+                    logging.debug(f'Failed to complete streamed message: {str(e)}')
+            else:
+                await self.__publish(chunk, markdown=True, priority=FINAL_EDIT_PRIORITY)
+            self.chunk_index += 1
+            self.message = None
+            self.rendered = ''
+
+    async def __publish(self, text: str, markdown: bool, priority: int) -> bool:
+        """
+        Sends or edits the current message, adapting the edit interval to Telegram's flood control.
+        :return: Whether the message was sent or edited
+        """
+        rate_limit_args = {'priority': priority}
+        try:
+            if self.inline_message_id is not None:
+                await edit_message_with_retry(self.context, chat_id=None, message_id=self.inline_message_id,
+                                              text=text, markdown=markdown, is_inline=True,
+                                              rate_limit_args=rate_limit_args)
+            elif self.message is None:
+                self.message, parse_mode = await reply_text_with_fallback(
+                    self.update.effective_message,
+                    text=text,
+                    markdown=markdown,
+                    message_thread_id=get_thread_id(self.update),
+                    reply_to_message_id=get_reply_to_message_id(self.config, self.update)
+                    if self.chunk_index == 0 else None
+                )
+                # Let a final edit with the same text be dropped
+                message_states = get_message_states(self.context.bot_data)
+                message_key = (self.message.chat_id, str(self.message.message_id))
+                message_states.record(message_key, text, parse_mode)
+                if markdown and parse_mode is None and get_parse_mode(text) is not None:
+                    # Telegram rejected the markdown, send the edits that extend the text as plain text right away
+                    message_states.get(message_key)['rejected_text'] = text
+            else:
+                await edit_message_with_retry(self.context, self.message.chat_id, str(self.message.message_id),
+                                              text=text, markdown=markdown, rate_limit_args=rate_limit_args)
+        except RetryAfter as e:
+            self.interval = min(self.interval * 2, self.max_interval)
+            self.next_edit_at = time.monotonic() + e.retry_after
+            logging.info(f'Flood control exceeded, editing streamed messages every {self.interval:.1f}s')
+            return False
+        except TimedOut:
+            self.interval = min(self.interval * 1.5, self.max_interval)
+            self.next_edit_at = time.monotonic() + self.interval
+            return False
+        except Exception as e:
+            logging.debug(f'Failed to render streamed message: {str(e)}')
+            self.next_edit_at = time.monotonic() + self.interval
+            return False
+
+        self.rendered = text
+        # Slowly go back to the base interval once Telegram accepts edits again
+        self.interval = max(self.base_interval, self.interval * 0.9)
+        self.next_edit_at = time.monotonic() + self.interval
+        return True
@@ -4,12 +4,13 @@ import asyncio
 import logging
 import os
 import io
+import time
+import weakref
 
 from uuid import uuid4
 from telegram import BotCommandScopeAllGroupChats, Update, constants
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle
 from telegram import InputTextMessageContent, BotCommand
-from telegram.error import RetryAfter, TimedOut, BadRequest
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, \
     filters, InlineQueryHandler, CallbackQueryHandler, Application, ContextTypes, CallbackContext
 
@@ -17,11 +18,13 @@ from pydub import AudioSegment
 from PIL import Image
 
 from utils import is_group_chat, get_thread_id, message_text, wrap_with_indicator, split_into_chunks, \
-    edit_message_with_retry, get_stream_cutoff_values, is_allowed, get_remaining_budget, is_admin, is_within_budget, \
+    edit_message_with_retry, is_allowed, get_remaining_budget, is_admin, is_within_budget, \
     get_reply_to_message_id, add_chat_request_to_usage_tracker, error_handler, is_direct_result, handle_direct_result, \
-    cleanup_intermediate_files
+    cleanup_intermediate_files, reply_text_with_fallback, get_message_states, get_usage_tracker
 from openai_helper import OpenAIHelper, localized_text
-from usage_tracker import UsageTracker
+from rate_limiter import TelegramRateLimiter
+from stream_renderer import StreamRenderer
+from lru_dict import LRUDict, estimate_size
 
 
 class ChatGPTTelegramBot:
@@ -42,7 +45,8 @@ class ChatGPTTelegramBot:
             BotCommand(command='help', description=localized_text('help_description', bot_language)),
             BotCommand(command='reset', description=localized_text('reset_description', bot_language)),
             BotCommand(command='stats', description=localized_text('stats_description', bot_language)),
-            BotCommand(command='resend', description=localized_text('resend_description', bot_language))
+            BotCommand(command='resend', description=localized_text('resend_description', bot_language)),
+            BotCommand(command='stop', description=localized_text('stop_description', bot_language))
         ]
         # If imaging is enabled, add the "image" command to the list
         if self.config.get('enable_image_generation', False):
@@ -56,9 +60,14 @@ class ChatGPTTelegramBot:
         )] + self.commands
         self.disallowed_message = localized_text('disallowed', bot_language)
         self.budget_limit_message = localized_text('budget_limit', bot_language)
-        self.usage = {}
-        self.last_message = {}
-        self.inline_queries_cache = {}
+        self.usage = LRUDict()
+        self.last_message = LRUDict()
+        self.inline_queries_cache = LRUDict()
+        self.memory_sweeper = None
+        self.message_states = None
+        self.chat_locks = weakref.WeakValueDictionary()  # {chat_id: lock}
+        self.pending_prompts = {}  # {(chat_id, user_id): prompts received within the debounce window}
+        self.active_requests = {}  # {chat_id: (user_id, task generating the answer)}
 
     async def help(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -92,19 +101,18 @@ class ChatGPTTelegramBot:
                      f'requested their usage statistics')
 
         user_id = update.message.from_user.id
-        if user_id not in self.usage:
-            self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+        user_usage = get_usage_tracker(self.usage, user_id, update.message.from_user.name)
 
-        tokens_today, tokens_month = self.usage[user_id].get_current_token_usage()
-        images_today, images_month = self.usage[user_id].get_current_image_count()
+        tokens_today, tokens_month = user_usage.get_current_token_usage()
+        images_today, images_month = user_usage.get_current_image_count()
         (transcribe_minutes_today, transcribe_seconds_today, transcribe_minutes_month,
-         transcribe_seconds_month) = self.usage[user_id].get_current_transcription_duration()
-        vision_today, vision_month = self.usage[user_id].get_current_vision_tokens()
-        characters_today, characters_month = self.usage[user_id].get_current_tts_usage()
-        current_cost = self.usage[user_id].get_current_cost()
+         transcribe_seconds_month) = user_usage.get_current_transcription_duration()
+        vision_today, vision_month = user_usage.get_current_vision_tokens()
+        characters_today, characters_month = user_usage.get_current_tts_usage()
+        current_cost = user_usage.get_current_cost()
 
         chat_id = update.effective_chat.id
-        chat_messages, chat_token_length = self.openai.get_conversation_stats(chat_id)
+        chat_messages, chat_token_length = await self.openai.get_conversation_stats(chat_id)
         remaining_budget = get_remaining_budget(self.config, self.usage, update)
         bot_language = self.config['bot_language']
         
@@ -227,12 +235,29 @@ class ChatGPTTelegramBot:
 
         chat_id = update.effective_chat.id
         reset_content = message_text(update.message)
-        self.openai.reset_chat_history(chat_id=chat_id, content=reset_content)
+        async with self.__chat_lock(chat_id):
+            await self.openai.reset_chat_history(chat_id=chat_id, content=reset_content)
         await update.effective_message.reply_text(
             message_thread_id=get_thread_id(update),
             text=localized_text('reset_done', self.config['bot_language'])
         )
 
+    async def stop(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Stops generating the answer in progress, keeping the part generated so far.
+        """
+        if not await is_allowed(self.config, update, context):
+            logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
+                            f'is not allowed to stop the answer')
+            await self.send_disallowed_message(update, context)
+            return
+
+        stopped = self.__stop_request(update.effective_chat.id)
+        await update.effective_message.reply_text(
+            message_thread_id=get_thread_id(update),
+            text=localized_text('stop_done' if stopped else 'stop_failed', self.config['bot_language'])
+        )
+
     async def image(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Generates an image for the given prompt using DALL·E APIs
@@ -269,7 +294,7 @@ class ChatGPTTelegramBot:
                     raise Exception(f"env variable IMAGE_RECEIVE_MODE has invalid value {self.config['image_receive_mode']}")
                 # add image request to users usage tracker
                 user_id = update.message.from_user.id
-                self.usage[user_id].add_image_request(image_size, self.config['image_prices'])
+                get_usage_tracker(self.usage, user_id, update.message.from_user.name).add_image_request(image_size, self.config['image_prices'])
                 # add guest chat request to guest usage tracker
                 if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
                     self.usage["guests"].add_image_request(image_size, self.config['image_prices'])
@@ -296,7 +321,7 @@ class ChatGPTTelegramBot:
 
         tts_query = message_text(update.message)
         if tts_query == "":
-            tts_query = self.openai.get_last_response(chat_id=update.effective_chat.id, role="assistant")
+            tts_query = await self.openai.get_last_response(chat_id=update.effective_chat.id, role="assistant")
             logging.info(f'New TTS request for existing assistant message: {tts_query}')
 
         if tts_query is None or tts_query == '':
@@ -320,7 +345,7 @@ class ChatGPTTelegramBot:
                 speech_file.close()
                 # add image request to users usage tracker
                 user_id = update.message.from_user.id
-                self.usage[user_id].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
+                get_usage_tracker(self.usage, user_id, update.message.from_user.name).add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
                 # add guest chat request to guest usage tracker
                 if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
                     self.usage["guests"].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
@@ -387,14 +412,13 @@ class ChatGPTTelegramBot:
                 return
 
             user_id = update.message.from_user.id
-            if user_id not in self.usage:
-                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
 
             try:
                 transcript = await self.openai.transcribe(filename_mp3)
 
                 transcription_price = self.config['transcription_price']
-                self.usage[user_id].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
+                user_usage = get_usage_tracker(self.usage, user_id, update.message.from_user.name)
+                user_usage.add_transcription_seconds(audio_track.duration_seconds, transcription_price)
 
                 allowed_user_ids = self.config['allowed_user_ids'].split(',')
                 if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
@@ -419,9 +443,11 @@ class ChatGPTTelegramBot:
                         )
                 else:
                     # Get the response of the transcript
-                    response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=transcript)
+                    async with self.__chat_lock(chat_id):
+                        response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=transcript)
 
-                    self.usage[user_id].add_chat_tokens(total_tokens, self.config['token_price'])
+                    user_usage = get_usage_tracker(self.usage, user_id, update.message.from_user.name)
+                    user_usage.add_chat_tokens(total_tokens, self.config['token_price'])
                     if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
                         self.usage["guests"].add_chat_tokens(total_tokens, self.config['token_price'])
 
@@ -520,87 +546,15 @@ class ChatGPTTelegramBot:
             
 
             user_id = update.message.from_user.id
-            if user_id not in self.usage:
-                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
 
             if self.config['stream']:
 
                 stream_response = self.openai.interpret_image_stream(chat_id=chat_id, fileobj=temp_file_png, prompt=prompt)
-                i = 0
-                prev = ''
-                sent_message = None
-                backoff = 0
-                stream_chunk = 0
-
-                async for content, tokens in stream_response:
-                    if is_direct_result(content):
-                        return await handle_direct_result(self.config, update, content)
-
-                    if len(content.strip()) == 0:
-                        continue
-
-                    stream_chunks = split_into_chunks(content)
-                    if len(stream_chunks) > 1:
-                        content = stream_chunks[-1]
-                        if stream_chunk != len(stream_chunks) - 1:
-                            stream_chunk += 1
-                            try:
-                                await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                              stream_chunks[-2])
-                            except:
-                                pass
-                            try:
-                                sent_message = await update.effective_message.reply_text(
-                                    message_thread_id=get_thread_id(update),
-                                    text=content if len(content) > 0 else "..."
-                                )
-                            except:
-                                pass
-                            continue
-
-                    cutoff = get_stream_cutoff_values(update, content)
-                    cutoff += backoff
-
-                    if i == 0:
-                        try:
-                            if sent_message is not None:
-                                await context.bot.delete_message(chat_id=sent_message.chat_id,
-                                                                 message_id=sent_message.message_id)
-                            sent_message = await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config, update),
-                                text=content,
-                            )
-                        except:
-                            continue
-
-                    elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                        prev = content
-
-                        try:
-                            use_markdown = tokens != 'not_finished'
-                            await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                          text=content, markdown=use_markdown)
-
-                        except RetryAfter as e:
-                            backoff += 5
-                            await asyncio.sleep(e.retry_after)
-                            continue
-
-                        except TimedOut:
-                            backoff += 5
-                            await asyncio.sleep(0.5)
-                            continue
-
-                        except Exception:
-                            backoff += 5
-                            continue
-
-                        await asyncio.sleep(0.01)
-
-                    i += 1
-                    if tokens != 'not_finished':
-                        total_tokens = int(tokens)
+                renderer = StreamRenderer(update, context, self.config)
+                content, tokens = await renderer.consume(stream_response)
+                if is_direct_result(content):
+                    return await handle_direct_result(self.config, update, content)
+                total_tokens = int(tokens)
 
                 
             else:
@@ -610,27 +564,20 @@ class ChatGPTTelegramBot:
 
 
                     try:
+                        await reply_text_with_fallback(
+                            update.effective_message,
+                            message_thread_id=get_thread_id(update),
+                            reply_to_message_id=get_reply_to_message_id(self.config, update),
+                            text=interpretation
+                        )
+                    except Exception as e:
+                        logging.exception(e)
                         await update.effective_message.reply_text(
                             message_thread_id=get_thread_id(update),
                             reply_to_message_id=get_reply_to_message_id(self.config, update),
-                            text=interpretation,
+                            text=f"{localized_text('vision_fail', bot_language)}: {str(e)}",
                             parse_mode=constants.ParseMode.MARKDOWN
                         )
-                    except BadRequest:
-                        try:
-                            await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config, update),
-                                text=interpretation
-                            )
-                        except Exception as e:
-                            logging.exception(e)
-                            await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config, update),
-                                text=f"{localized_text('vision_fail', bot_language)}: {str(e)}",
-                                parse_mode=constants.ParseMode.MARKDOWN
-                            )
                 except Exception as e:
                     logging.exception(e)
                     await update.effective_message.reply_text(
@@ -640,13 +587,14 @@ class ChatGPTTelegramBot:
                         parse_mode=constants.ParseMode.MARKDOWN
                     )
             vision_token_price = self.config['vision_token_price']
-            self.usage[user_id].add_vision_tokens(total_tokens, vision_token_price)
+            get_usage_tracker(self.usage, user_id, update.message.from_user.name).add_vision_tokens(total_tokens, vision_token_price)
 
             allowed_user_ids = self.config['allowed_user_ids'].split(',')
             if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
                 self.usage["guests"].add_vision_tokens(total_tokens, vision_token_price)
 
-        await wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
+        async with self.__chat_lock(chat_id):
+            await wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
 
     async def prompt(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
@@ -683,6 +631,33 @@ class ChatGPTTelegramBot:
                     logging.warning('Message does not start with trigger keyword, ignoring...')
                     return
 
+        prompt = await self.__batch_rapid_messages(chat_id, user_id, prompt)
+        if prompt is None:
+            # Merged into a message of the same user that arrived right after this one
+            return
+        self.last_message[chat_id] = prompt
+
+        if self.config['stop_on_new_message']:
+            self.__stop_request(chat_id, user_id)
+
+        async with self.__chat_lock(chat_id):
+            # The answer is generated in a task of its own, which /stop can cancel without cancelling this handler
+            answer = asyncio.create_task(self.__answer(update, context, chat_id, user_id, prompt))
+            self.active_requests[chat_id] = (user_id, answer)
+            try:
+                await asyncio.wait({answer})
+            except asyncio.CancelledError:
+                answer.cancel()
+                raise
+            finally:
+                if self.active_requests.get(chat_id, (None, None))[1] is answer:
+                    del self.active_requests[chat_id]
+
+    async def __answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int,
+                       prompt: str):
+        """
+        Generates the answer to a prompt and sends it, billing the tokens used even if the answer is stopped.
+        """
         try:
             total_tokens = 0
 
@@ -693,81 +668,18 @@ class ChatGPTTelegramBot:
                 )
 
                 stream_response = self.openai.get_chat_response_stream(chat_id=chat_id, query=prompt)
-                i = 0
-                prev = ''
-                sent_message = None
-                backoff = 0
-                stream_chunk = 0
-
-                async for content, tokens in stream_response:
-                    if is_direct_result(content):
-                        return await handle_direct_result(self.config, update, content)
-
-                    if len(content.strip()) == 0:
-                        continue
-
-                    stream_chunks = split_into_chunks(content)
-                    if len(stream_chunks) > 1:
-                        content = stream_chunks[-1]
-                        if stream_chunk != len(stream_chunks) - 1:
-                            stream_chunk += 1
-                            try:
-                                await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                              stream_chunks[-2])
-                            except:
-                                pass
-                            try:
-                                sent_message = await update.effective_message.reply_text(
-                                    message_thread_id=get_thread_id(update),
-                                    text=content if len(content) > 0 else "..."
-                                )
-                            except:
-                                pass
-                            continue
-
-                    cutoff = get_stream_cutoff_values(update, content)
-                    cutoff += backoff
-
-                    if i == 0:
-                        try:
-                            if sent_message is not None:
-                                await context.bot.delete_message(chat_id=sent_message.chat_id,
-                                                                 message_id=sent_message.message_id)
-                            sent_message = await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config, update),
-                                text=content,
-                            )
-                        except:
-                            continue
-
-                    elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                        prev = content
-
-                        try:
-                            use_markdown = tokens != 'not_finished'
-                            await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                          text=content, markdown=use_markdown)
-
-                        except RetryAfter as e:
-                            backoff += 5
-                            await asyncio.sleep(e.retry_after)
-                            continue
-
-                        except TimedOut:
-                            backoff += 5
-                            await asyncio.sleep(0.5)
-                            continue
-
-                        except Exception:
-                            backoff += 5
-                            continue
-
-                        await asyncio.sleep(0.01)
-
-                    i += 1
-                    if tokens != 'not_finished':
-                        total_tokens = int(tokens)
+                renderer = StreamRenderer(update, context, self.config)
+                try:
+                    content, tokens = await renderer.consume(stream_response)
+                except asyncio.CancelledError:
+                    # Stopped, bill the tokens used until then
+                    add_chat_request_to_usage_tracker(self.usage, self.config, user_id,
+                                                      self.openai.pop_stopped_tokens(chat_id),
+                                                      update.effective_user.name)
+                    raise
+                if is_direct_result(content):
+                    return await handle_direct_result(self.config, update, content)
+                total_tokens = int(tokens)
 
             else:
                 async def _reply():
@@ -781,28 +693,18 @@ class ChatGPTTelegramBot:
                     chunks = split_into_chunks(response)
 
                     for index, chunk in enumerate(chunks):
-                        try:
-                            await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config,
-                                                                            update) if index == 0 else None,
-                                text=chunk,
-                                parse_mode=constants.ParseMode.MARKDOWN
-                            )
-                        except Exception:
-                            try:
-                                await update.effective_message.reply_text(
-                                    message_thread_id=get_thread_id(update),
-                                    reply_to_message_id=get_reply_to_message_id(self.config,
-                                                                                update) if index == 0 else None,
-                                    text=chunk
-                                )
-                            except Exception as exception:
-                                raise exception
+                        await reply_text_with_fallback(
+                            update.effective_message,
+                            message_thread_id=get_thread_id(update),
+                            reply_to_message_id=get_reply_to_message_id(self.config,
+                                                                        update) if index == 0 else None,
+                            text=chunk
+                        )
 
                 await wrap_with_indicator(update, context, _reply, constants.ChatAction.TYPING)
 
-            add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
+            add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens,
+                                              update.effective_user.name)
 
         except Exception as e:
             logging.exception(e)
@@ -813,6 +715,64 @@ class ChatGPTTelegramBot:
                 parse_mode=constants.ParseMode.MARKDOWN
             )
 
+    def __stop_request(self, chat_id: int, user_id: int = None) -> bool:
+        """
+        Cancels the request generating an answer in the given chat, which closes its stream right away.
+        :param chat_id: The chat ID
+        :param user_id: Only cancel the request if it was sent by this user
+        :return: Whether a request was cancelled
+        """
+        user_and_task = self.active_requests.get(chat_id)
+        if user_and_task is None:
+            return False
+        request_user_id, task = user_and_task
+        if task.done() or (user_id is not None and request_user_id != user_id):
+            return False
+        logging.info(f'Stopping the answer in progress in chat {chat_id}')
+        task.cancel()
+        return True
+
+    def __chat_lock(self, chat_id: int) -> asyncio.Lock:
+        """
+        Returns the lock serializing the requests of the given chat, so that only one response
+        is generated at a time and the conversation history isn't modified concurrently.
+        """
+        lock = self.chat_locks.get(chat_id)
+        if lock is None:
+            lock = self.chat_locks[chat_id] = asyncio.Lock()
+        return lock
+
+    async def __batch_rapid_messages(self, chat_id: int, user_id: int, prompt: str) -> str | None:
+        """
+        Waits for the debounce window and merges the messages a user sent in quick succession into a single prompt.
+        Messages to a chat that isn't generating an answer are answered right away, only the messages that arrive
+        while an answer is pending or being generated are delayed and merged.
+        :param chat_id: The chat ID
+        :param user_id: The user ID
+        :param prompt: The prompt of the received message
+        :return: The merged prompt for the last received message, None for the messages merged into it
+        """
+        debounce_seconds = self.config['message_debounce_seconds']
+        if debounce_seconds <= 0:
+            return prompt
+
+        key = (chat_id, user_id)
+        lock = self.chat_locks.get(chat_id)
+        if key not in self.pending_prompts and (lock is None or not lock.locked()):
+            return prompt
+
+        pending = self.pending_prompts.setdefault(key, [])
+        pending.append(prompt)
+        received = len(pending)
+        await asyncio.sleep(debounce_seconds)
+        if self.pending_prompts.get(key) is not pending or len(pending) != received:
+            return None
+
+        del self.pending_prompts[key]
+        if len(pending) > 1:
+            logging.info(f'Merging {len(pending)} messages from user {user_id} in chat {chat_id} into one prompt')
+        return '\n'.join(pending)
+
     async def inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Handle the inline query. This is run when you type: @botusername <query>
@@ -891,12 +851,13 @@ class ChatGPTTelegramBot:
                     return
 
                 unavailable_message = localized_text("function_unavailable_in_inline_mode", bot_language)
-                if self.config['stream']:
-                    stream_response = self.openai.get_chat_response_stream(chat_id=user_id, query=query)
-                    i = 0
-                    prev = ''
-                    backoff = 0
-                    async for content, tokens in stream_response:
+                async with self.__chat_lock(user_id):
+                    if self.config['stream']:
+                        stream_response = self.openai.get_chat_response_stream(chat_id=user_id, query=query)
+                        renderer = StreamRenderer(update, context, self.config, inline_message_id=inline_message_id,
+                                                  header=f'{query}\n\n{answer_tr}:\n',
+                                                  markdown_header=f'{query}\n\n_{answer_tr}:_\n')
+                        content, tokens = await renderer.consume(stream_response)
                         if is_direct_result(content):
                             cleanup_intermediate_files(content)
                             await edit_message_with_retry(context, chat_id=None,
@@ -904,85 +865,41 @@ class ChatGPTTelegramBot:
                                                           text=f'{query}\n\n_{answer_tr}:_\n{unavailable_message}',
                                                           is_inline=True)
                             return
+                        total_tokens = int(tokens)
 
-                        if len(content.strip()) == 0:
-                            continue
+                    else:
+                        async def _send_inline_query_response():
+                            nonlocal total_tokens
+                            # Edit the current message to indicate that the answer is being processed
+                            await context.bot.edit_message_text(inline_message_id=inline_message_id,
+                                                                text=f'{query}\n\n_{answer_tr}:_\n{loading_tr}',
+                                                                parse_mode=constants.ParseMode.MARKDOWN)
 
-                        cutoff = get_stream_cutoff_values(update, content)
-                        cutoff += backoff
+                            logging.info(f'Generating response for inline query by {name}')
+                            response, total_tokens = await self.openai.get_chat_response(chat_id=user_id, query=query)
 
-                        if i == 0:
-                            try:
+                            if is_direct_result(response):
+                                cleanup_intermediate_files(response)
                                 await edit_message_with_retry(context, chat_id=None,
                                                               message_id=inline_message_id,
-                                                              text=f'{query}\n\n{answer_tr}:\n{content}',
+                                                              text=f'{query}\n\n_{answer_tr}:_\n{unavailable_message}',
                                                               is_inline=True)
-                            except:
-                                continue
-
-                        elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                            prev = content
-                            try:
-                                use_markdown = tokens != 'not_finished'
-                                divider = '_' if use_markdown else ''
-                                text = f'{query}\n\n{divider}{answer_tr}:{divider}\n{content}'
-
-                                # We only want to send the first 4096 characters. No chunking allowed in inline mode.
-                                text = text[:4096]
-
-                                await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
-                                                              text=text, markdown=use_markdown, is_inline=True)
-
-                            except RetryAfter as e:
-                                backoff += 5
-                                await asyncio.sleep(e.retry_after)
-                                continue
-                            except TimedOut:
-                                backoff += 5
-                                await asyncio.sleep(0.5)
-                                continue
-                            except Exception:
-                                backoff += 5
-                                continue
-
-                            await asyncio.sleep(0.01)
-
-                        i += 1
-                        if tokens != 'not_finished':
-                            total_tokens = int(tokens)
+                                return
 
-                else:
-                    async def _send_inline_query_response():
-                        nonlocal total_tokens
-                        # Edit the current message to indicate that the answer is being processed
-                        await context.bot.edit_message_text(inline_message_id=inline_message_id,
-                                                            text=f'{query}\n\n_{answer_tr}:_\n{loading_tr}',
-                                                            parse_mode=constants.ParseMode.MARKDOWN)
-
-                        logging.info(f'Generating response for inline query by {name}')
-                        response, total_tokens = await self.openai.get_chat_response(chat_id=user_id, query=query)
-
-                        if is_direct_result(response):
-                            cleanup_intermediate_files(response)
-                            await edit_message_with_retry(context, chat_id=None,
-                                                          message_id=inline_message_id,
-                                                          text=f'{query}\n\n_{answer_tr}:_\n{unavailable_message}',
-                                                          is_inline=True)
-                            return
+                            text_content = f'{query}\n\n_{answer_tr}:_\n{response}'
 
-                        text_content = f'{query}\n\n_{answer_tr}:_\n{response}'
+                            # We only want to send the first 4096 characters. No chunking allowed in inline mode.
+                            text_content = text_content[:4096]
 
-                        # We only want to send the first 4096 characters. No chunking allowed in inline mode.
-                        text_content = text_content[:4096]
+                            # Edit the original message with the generated content
+                            await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
+                                                          text=text_content, is_inline=True)
 
-                        # Edit the original message with the generated content
-                        await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
-                                                      text=text_content, is_inline=True)
+                        await wrap_with_indicator(update, context, _send_inline_query_response,
+                                                  constants.ChatAction.TYPING, is_inline=True)
 
-                    await wrap_with_indicator(update, context, _send_inline_query_response,
-                                              constants.ChatAction.TYPING, is_inline=True)
-
-                add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
+                add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens,
+                                                  update.effective_user.name)
 
         except Exception as e:
             logging.error(f'Failed to respond to an inline query via button callback: {e}')
@@ -1048,6 +965,122 @@ class ChatGPTTelegramBot:
         """
         await application.bot.set_my_commands(self.group_commands, scope=BotCommandScopeAllGroupChats())
         await application.bot.set_my_commands(self.commands)
+        self.message_states = get_message_states(application.bot_data)
+        self.memory_sweeper = asyncio.create_task(self.sweep_memory_periodically())
+        if self.openai.config['enable_functions']:
+            spec_tokens = await self.openai.get_plugin_spec_tokens()
+            if spec_tokens:
+                logging.info(f'Function specs add about {sum(spec_tokens.values())} tokens to every prompt: '
+                             + ', '.join(f'{name}={tokens}' for name, tokens in spec_tokens.items()))
+
+    async def post_shutdown(self, application: Application) -> None:
+        """
+        Post shutdown hook for the bot.
+        """
+        if self.memory_sweeper is not None:
+            self.memory_sweeper.cancel()
+        await self.openai.plugin_manager.close()
+
+    async def sweep_memory_periodically(self):
+        """
+        Periodically evicts expired per-chat state from memory, and the least recently used state
+        if the configured memory cap is exceeded.
+        """
+        while True:
+            await asyncio.sleep(self.config['memory_sweep_interval_seconds'])
+            try:
+                self.sweep_memory()
+            except Exception as e:
+                logging.exception(f'Error while sweeping memory: {str(e)}')
+
+    def sweep_memory(self):
+        """
+        Evicts the per-chat state that was not used for longer than the maximum conversation age, then evicts the
+        least recently used state until the estimated memory usage is below the cap, and logs the memory usage.
+        """
+        max_idle_seconds = self.config['max_conversation_age_minutes'] * 60
+        evicted = self.openai.evict_expired_conversations(self.__busy_chat_ids())
+        # The guests' usage tracker is shared by all guests and holds their budget, it is never evicted
+        evicted += self.usage.evict_idle(max_idle_seconds, keep={'guests'})
+        for cache in (self.last_message, self.inline_queries_cache):
+            evicted += cache.evict_idle(max_idle_seconds)
+
+        stats = self.get_memory_stats()
+        max_bytes = self.config['max_memory_mb'] * 1024 * 1024
+        if max_bytes > 0 and sum(size for _, size in stats.values()) > max_bytes:
+            evicted += self.__evict_least_recently_used(max_bytes)
+            stats = self.get_memory_stats()
+
+        if evicted > 0:
+            logging.info(f'Evicted {evicted} entries from memory')
+        logging.info('Memory usage: ' + ', '.join(f'{name}={count} ({size / 1024:.1f} KB)'
+                                                  for name, (count, size) in stats.items()))
+        if self.message_states is not None:
+            logging.info(f'Suppressed {self.message_states.suppressed_edits} edits that would not have '
+                         f'changed their message')
+        plugin_cache = self.openai.plugin_manager.cache
+        logging.info(f'Plugin cache: {plugin_cache.hits} hits, {plugin_cache.misses} misses')
+        response_cache = self.openai.response_cache
+        if response_cache is not None:
+            logging.info(f'Response cache: {response_cache.hits} hits, {response_cache.misses} misses')
+
+    def get_memory_stats(self) -> dict[str: tuple[int, int]]:
+        """
+        Returns the number of entries and the estimated number of bytes of each per-chat map held in memory.
+        """
+        stats = self.openai.get_memory_stats()
+        stats['usage'] = (len(self.usage), estimate_size(list(self.usage.values())))
+        stats['last_message'] = (len(self.last_message), estimate_size(list(self.last_message.values())))
+        stats['inline_queries_cache'] = (len(self.inline_queries_cache),
+                                         estimate_size(list(self.inline_queries_cache.values())))
+        if self.message_states is not None:
+            stats['message_states'] = (len(self.message_states), estimate_size(self.message_states.states))
+        plugin_cache = self.openai.plugin_manager.cache
+        stats['plugin_cache'] = (len(plugin_cache), estimate_size(plugin_cache.entries))
+        return stats
+
+    def __busy_chat_ids(self) -> set[int]:
+        """
+        Returns the chats with a request in progress or waiting for one to finish.
+        """
+        busy_chat_ids = {chat_id for chat_id, lock in list(self.chat_locks.items()) if lock.locked()}
+        return busy_chat_ids | set(self.active_requests)
+
+    def __evict_least_recently_used(self, max_bytes: int) -> int:
+        """
+        Evicts the least recently used conversations, usage trackers and cached messages across all maps
+        until their estimated size is below the given number of bytes.
+        Entries used within the last minute are never evicted, as they may belong to a request in progress,
+        and neither are the entries of chats and users with a request in progress, however long it takes,
+        nor the guests' usage tracker. Evicted usage trackers are loaded from their usage logs again when needed.
+        :param max_bytes: The maximum number of bytes to keep in memory
+        :return: The number of evicted entries
+        """
+        busy_chat_ids = self.__busy_chat_ids() | set(self.openai.summarisation_tasks)
+        busy_user_ids = busy_chat_ids | {user_id for user_id, _ in self.active_requests.values()} | {'guests'}
+        conversations = self.openai.conversations
+        candidates = [(conversations.accessed_at[chat_id], self.openai.conversation_size(chat_id),
+                       self.openai.evict_conversation, chat_id, chat_id in busy_chat_ids) for chat_id in conversations]
+        for cache, busy_keys in ((self.usage, busy_user_ids), (self.last_message, busy_chat_ids),
+                                 (self.inline_queries_cache, set())):
+            candidates += [(cache.accessed_at[key], estimate_size(cache.peek(key)), cache.pop, key, key in busy_keys)
+                           for key in cache]
+        candidates.sort(key=lambda candidate: candidate[0])
+
+        total_bytes = sum(candidate[1] for candidate in candidates)
+        evicted = 0
+        for accessed_at, size, evict, key, busy in candidates:
+            if total_bytes <= max_bytes or time.monotonic() - accessed_at < 60:
+                break
+            if busy:
+                continue
+            evict(key)
+            total_bytes -= size
+            evicted += 1
+        if total_bytes > max_bytes:
+            logging.warning(f'Memory usage of {total_bytes / 1024 / 1024:.1f} MB still exceeds the cap '
+                            f'of {self.config["max_memory_mb"]} MB, all remaining entries are in use')
+        return evicted
 
     def run(self):
         """
@@ -1058,6 +1091,8 @@ class ChatGPTTelegramBot:
             .proxy_url(self.config['proxy']) \
             .get_updates_proxy_url(self.config['proxy']) \
             .post_init(self.post_init) \
+            .post_shutdown(self.post_shutdown) \
+            .rate_limiter(TelegramRateLimiter()) \
             .concurrent_updates(True) \
             .build()
 
@@ -1068,6 +1103,7 @@ class ChatGPTTelegramBot:
         application.add_handler(CommandHandler('start', self.help))
         application.add_handler(CommandHandler('stats', self.stats))
         application.add_handler(CommandHandler('resend', self.resend))
+        application.add_handler(CommandHandler('stop', self.stop))
         application.add_handler(CommandHandler(
             'chat', self.prompt, filters=filters.ChatType.GROUP | filters.ChatType.SUPERGROUP)
         )
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import re
+
+# A backslash escapes an entity character outside of entities, otherwise the character starts an entity
+ENTITY_START_PATTERN = re.compile(r'\\[_*`\[]|[_*`\[]')
+
+
+def find_unclosed_entity(text: str) -> tuple[int, str] | None:
+    """
+    Finds the entity that Telegram's legacy Markdown parser would reject as unclosed.
+    Entities can't be nested, so everything after the start of an entity up to its closing delimiter is plain
+    text, and only the first unclosed entity matters.
+    :param text: The text to check
+    :return: The offset of the unclosed entity and the delimiter that closes it, or None if the text is valid
+    """
+    position = 0
+    while True:
+        match = ENTITY_START_PATTERN.search(text, position)
+        if match is None:
+            return None
+        token = match.group()
+        if token[0] == '\\':
+            position = match.end()
+            continue
+
+        start = match.start()
+        if text.startswith('```', start):
+            closing, content_start = '```', start + 3
+        else:
+            closing, content_start = (']' if token == '[' else token), start + 1
+        end = text.find(closing, content_start)
+        if end < 0:
+            return start, closing
+        position = end + len(closing)
+        if token == '[' and text.startswith('(', position):
+            # The URL of an inline link is not markdown, it ends at the first closing parenthesis
+            end = text.find(')', position + 1)
+            if end < 0:
+                return position, ')'
+            position = end + 1
+
+
+def is_valid_markdown(text: str) -> bool:
+    """
+    Whether Telegram accepts the given text with the legacy Markdown parse mode.
+    """
+    return find_unclosed_entity(text) is None
+
+
+def close_markdown(text: str, max_length: int = 4096) -> str | None:
+    """
+    Closes the entity left open at the end of a partial answer, e.g. while it is being streamed,
+    so that it can be shown with markdown. The URL of a link that isn't complete yet is left out.
+    :param text: The partial answer
+    :param max_length: The maximum length of the closed text
+    :return: The text with its open entity closed, or None if it would become too long
+    """
+    unclosed = find_unclosed_entity(text)
+    if unclosed is None:
+        return text
+    offset, closing = unclosed
+    if closing == ')':
+        # Leave out the URL of a link until it is complete, instead of linking to a partial one
+        return text[:offset]
+    if closing == '```' and not text.endswith('\n'):
+        closing = '\n```'
+    return text + closing if len(text) + len(closing) <= max_length else None
@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import tiktoken
+
+
+class Tokenizer:
+    """
+    Counts tokens with tiktoken, resolving the encoding of each model only once.
+    Short strings are encoded inline, while large payloads (e.g. plugin results or long
+    conversation summaries) are encoded in a bounded thread pool so that they don't block the event loop.
+    """
+
+    def __init__(self, max_workers: int = 2, inline_threshold: int = 2048):
+        """
+        Initializes the tokenizer.
+        :param max_workers: The maximum number of threads used to encode large payloads
+        :param inline_threshold: The number of characters up to which text is encoded on the event loop
+        """
+        self.inline_threshold = inline_threshold
+        self.encodings: dict[str: tiktoken.Encoding] = {}  # {model: encoding}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tokenizer')
+
+    def get_encoding(self, model: str) -> tiktoken.Encoding:
+        """
+        Returns the encoding for the given model, falling back to cl100k_base for unknown models.
+        :param model: The model name
+        :return: The cached encoding
+        """
+        encoding = self.encodings.get(model)
+        if encoding is None:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                logging.debug(f'No tiktoken encoding found for model {model}, using cl100k_base')
+                encoding = tiktoken.get_encoding("cl100k_base")
+            self.encodings[model] = encoding
+        return encoding
+
+    def count_inline(self, text: str, model: str) -> int:
+        """
+        Counts the tokens of the given text on the calling thread.
+        :param text: The text to count
+        :param model: The model name
+        :return: The number of tokens
+        """
+        return len(self.get_encoding(model).encode(text))
+
+    async def count(self, text: str, model: str) -> int:
+        """
+        Counts the tokens of the given text, off the event loop if the text is large.
+        :param text: The text to count
+        :param model: The model name
+        :return: The number of tokens
+        """
+        if len(text) <= self.inline_threshold:
+            return self.count_inline(text, model)
+        return (await self.count_batch([text], model))[0]
+
+    async def count_batch(self, texts: list[str], model: str) -> list[int]:
+        """
+        Counts the tokens of each of the given texts, encoding them in a single
+        `encode_batch` call in the thread pool if they are large.
+        :param texts: The texts to count
+        :param model: The model name
+        :return: The number of tokens of each text
+        """
+        encoding = self.get_encoding(model)
+        if sum(len(text) for text in texts) <= self.inline_threshold:
+            return [len(encoding.encode(text)) for text in texts]
+        loop = asyncio.get_running_loop()
+        encoded = await loop.run_in_executor(self.executor, encoding.encode_batch, texts)
+        return [len(tokens) for tokens in encoded]
@@ -11,6 +11,10 @@ import telegram
 from telegram import Message, MessageEntity, Update, ChatMember, constants
 from telegram.ext import CallbackContext, ContextTypes
 
+from chat_action_indicator import ChatActionIndicator
+from message_splitter import MessageSplitter
+from message_states import MessageStates
+from telegram_markdown import is_valid_markdown
 from usage_tracker import UsageTracker
 
 
@@ -54,18 +58,6 @@ def get_thread_id(update: Update) -> int | None:
     return None
 
 
-def get_stream_cutoff_values(update: Update, content: str) -> int:
-    """
-    Gets the stream cutoff values for the message length
-    """
-    if is_group_chat(update):
-        # group chats have stricter flood limits
-        return 180 if len(content) > 1000 else 120 if len(content) > 200 \
-            else 90 if len(content) > 50 else 50
-    return 90 if len(content) > 1000 else 45 if len(content) > 200 \
-        else 25 if len(content) > 50 else 15
-
-
 def is_group_chat(update: Update) -> bool:
     """
     Checks if the message was sent from a group chat
@@ -80,58 +72,126 @@ def is_group_chat(update: Update) -> bool:
 
 def split_into_chunks(text: str, chunk_size: int = 4096) -> list[str]:
     """
-    Splits a string into chunks of a given size.
+    Splits a markdown string into chunks of at most the given size, preferably at paragraph or line boundaries,
+    closing and reopening code blocks that span several chunks.
     """
-    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+    splitter = MessageSplitter(chunk_size)
+    chunks = splitter.split(text)
+    last_chunk = splitter.current(text)
+    if last_chunk.strip():
+        chunks.append(last_chunk)
+    return chunks
 
 
 async def wrap_with_indicator(update: Update, context: CallbackContext, coroutine,
                               chat_action: constants.ChatAction = "", is_inline=False):
     """
-    Wraps a coroutine while repeatedly sending a chat action to the user.
+    Wraps a coroutine while showing a chat action to the user.
+    The chat action is shared with the other jobs running in the same chat.
+    Cancelling the wrapper cancels the coroutine too.
     """
     task = context.application.create_task(coroutine(), update=update)
-    while not task.done():
-        if not is_inline:
-            context.application.create_task(
-                update.effective_chat.send_action(chat_action, message_thread_id=get_thread_id(update))
-            )
-        try:
-            await asyncio.wait_for(asyncio.shield(task), 4.5)
-        except asyncio.TimeoutError:
-            pass
+    if is_inline:
+        await task
+        return
+    indicator = get_chat_action_indicator(context.bot_data)
+    async with indicator.indicate(context.bot, update.effective_chat.id, get_thread_id(update), chat_action):
+        await task
+
+
+def get_chat_action_indicator(bot_data: dict) -> ChatActionIndicator:
+    """
+    Returns the indicator of the chat actions of running jobs, kept in the bot data
+    """
+    return bot_data.setdefault('chat_action_indicator', ChatActionIndicator())
+
+
+def get_parse_mode(text: str) -> constants.ParseMode | None:
+    """
+    Returns the markdown parse mode if Telegram will accept the text with it, otherwise None for plain text
+    """
+    return constants.ParseMode.MARKDOWN if is_valid_markdown(text) else None
+
+
+async def reply_text_with_fallback(message: Message, text: str, markdown: bool = True,
+                                   **kwargs) -> tuple[Message, str | None]:
+    """
+    Replies to a message, formatted with markdown if the text is valid markdown, otherwise as plain text
+    :param message: The message to reply to
+    :param text: The text of the reply
+    :param markdown: Whether to format the reply with markdown if possible
+    :param kwargs: Further arguments of `Message.reply_text`
+    :return: The sent message and the parse mode it was sent with, None if Telegram rejected the markdown
+    """
+    parse_mode = get_parse_mode(text) if markdown else None
+    try:
+        return await message.reply_text(text=text, parse_mode=parse_mode, **kwargs), parse_mode
+    except telegram.error.BadRequest:
+        if parse_mode is None:
+            raise
+        return await message.reply_text(text=text, **kwargs), None
+
+
+def get_message_states(bot_data: dict) -> MessageStates:
+    """
+    Returns the states of the recently edited messages, kept in the bot data
+    """
+    return bot_data.setdefault('message_states', MessageStates())
 
 
 async def edit_message_with_retry(context: ContextTypes.DEFAULT_TYPE, chat_id: int | None,
-                                  message_id: str, text: str, markdown: bool = True, is_inline: bool = False):
+                                  message_id: str, text: str, markdown: bool = True, is_inline: bool = False,
+                                  rate_limit_args: dict = None):
     """
-    Edit a message with retry logic in case of failure (e.g. broken markdown)
+    Edit a message, formatted with markdown if the text is valid markdown, otherwise as plain text.
+    If Telegram rejects markdown the local validator accepted, the edit is retried as plain text,
+    and further edits of the message that extend the rejected text are sent as plain text right away.
+    Edits that wouldn't change the text or parse mode of the message are dropped without a request.
     :param context: The context to use
     :param chat_id: The chat id to edit the message in
     :param message_id: The message id to edit
     :param text: The text to edit the message with
     :param markdown: Whether to use markdown parse mode
     :param is_inline: Whether the message to edit is an inline message
+    :param rate_limit_args: The arguments for the rate limiter, e.g. the priority of the edit
     :return: None
     """
+    message_states = get_message_states(context.bot_data)
+    message_key = (chat_id, message_id)
+    state = message_states.get(message_key)
+    parse_mode = get_parse_mode(text) if markdown else None
+    if parse_mode is not None and state['rejected_text'] is not None and text.startswith(state['rejected_text']):
+        parse_mode = None
+    if message_states.is_unchanged(message_key, text, parse_mode):
+        return
+
     try:
         await context.bot.edit_message_text(
             chat_id=chat_id,
             message_id=int(message_id) if not is_inline else None,
             inline_message_id=message_id if is_inline else None,
             text=text,
-            parse_mode=constants.ParseMode.MARKDOWN if markdown else None,
+            parse_mode=parse_mode,
+            rate_limit_args=rate_limit_args,
         )
+        message_states.record(message_key, text, parse_mode)
     except telegram.error.BadRequest as e:
         if str(e).startswith("Message is not modified"):
+            message_states.record(message_key, text, parse_mode)
             return
+        if parse_mode is None:
+            logging.warning(f'Failed to edit message: {str(e)}')
+            raise e
+        state['rejected_text'] = text
         try:
             await context.bot.edit_message_text(
                 chat_id=chat_id,
                 message_id=int(message_id) if not is_inline else None,
                 inline_message_id=message_id if is_inline else None,
                 text=text,
+                rate_limit_args=rate_limit_args,
             )
+            message_states.record(message_key, text, None)
         except Exception as e:
             logging.warning(f'Failed to edit message: {str(e)}')
             raise e
@@ -226,6 +286,21 @@ def get_user_budget(config, user_id) -> float | None:
     return None
 
 
+def get_usage_tracker(usage, user_id, user_name: str = None) -> UsageTracker:
+    """
+    Returns the usage tracker of the given user, loading it from its usage log again if it was evicted from memory
+    :param usage: The usage tracker object
+    :param user_id: The user id, or 'guests'
+    :param user_name: The user name, stored if the user has no usage log yet
+    :return: The usage tracker of the user
+    """
+    if user_id not in usage:
+        if user_id == 'guests':
+            user_name = 'all guest users in group chats'
+        usage[user_id] = UsageTracker(user_id, user_name)
+    return usage[user_id]
+
+
 def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
     """
     Calculate the remaining budget for a user based on their current usage.
@@ -244,20 +319,17 @@ def get_remaining_budget(config, usage, update: Update, is_inline=False) -> floa
 
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
+    user_usage = get_usage_tracker(usage, user_id, name)
 
     # Get budget for users
     user_budget = get_user_budget(config, user_id)
     budget_period = config['budget_period']
     if user_budget is not None:
-        cost = usage[user_id].get_current_cost()[budget_cost_map[budget_period]]
+        cost = user_usage.get_current_cost()[budget_cost_map[budget_period]]
         return user_budget - cost
 
     # Get budget for guests
-    if 'guests' not in usage:
-        usage['guests'] = UsageTracker('guests', 'all guest users in group chats')
-    cost = usage['guests'].get_current_cost()[budget_cost_map[budget_period]]
+    cost = get_usage_tracker(usage, 'guests').get_current_cost()[budget_cost_map[budget_period]]
     return config['guest_budget'] - cost
 
 
@@ -273,26 +345,27 @@ def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
     """
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
+    get_usage_tracker(usage, user_id, name)
     remaining_budget = get_remaining_budget(config, usage, update, is_inline=is_inline)
     return remaining_budget > 0
 
 
-def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens):
+def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens, user_name: str = None):
     """
     Add chat request to usage tracker
     :param usage: The usage tracker object
     :param config: The bot configuration object
     :param user_id: The user id
     :param used_tokens: The number of tokens used
+    :param user_name: The user name, stored if the user has no usage log yet
     """
     try:
         if int(used_tokens) == 0:
-            logging.warning('No tokens used. Not adding chat request to usage tracker.')
+            # Served from the response cache or shared with an identical request in flight, nothing to bill
+            logging.debug('No tokens used. Not adding chat request to usage tracker.')
             return
         # add chat request to users usage tracker
-        usage[user_id].add_chat_tokens(used_tokens, config['token_price'])
+        get_usage_tracker(usage, user_id, user_name).add_chat_tokens(used_tokens, config['token_price'])
         # add guest chat request to guest usage tracker
         allowed_user_ids = config['allowed_user_ids'].split(',')
         if str(user_id) not in allowed_user_ids and 'guests' in usage: